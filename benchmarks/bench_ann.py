@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Compare approximate (IVFIndex) and exact (match_top_k) 1:N identification on a
+synthetic gallery: build time, query latency and recall@k per nprobe.
+
+    $ python benchmarks/bench_ann.py --gallery-size 1000000 --nprobe 1 4 16 64
+"""
+from __future__ import print_function
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from face_recognition import api
+from face_recognition.ann import IVFIndex, recall_at_k
+
+
+def synthetic_encodings(gallery_size, probes, identities, seed=0):
+    """
+    Gallery and probe encodings clustered around random identities, with the
+    spread of real 128-d face encodings (norm close to 1).
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(0, 0.09, (identities, 128))
+    gallery = centers[rng.randint(0, identities, gallery_size)] + rng.normal(0, 0.03, (gallery_size, 128))
+    queries = gallery[rng.randint(0, gallery_size, probes)] + rng.normal(0, 0.02, (probes, 128))
+    return gallery, queries
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--gallery-size', type=int, default=100000)
+    p.add_argument('--identities', type=int, default=10000)
+    p.add_argument('--probes', type=int, default=200)
+    p.add_argument('--k', type=int, default=10)
+    p.add_argument('--nlist', type=int, default=None)
+    p.add_argument('--pq', type=int, default=0, help="PQ subquantizers (0 = uncompressed lists)")
+    p.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64])
+    args = p.parse_args()
+
+    gallery, probes = synthetic_encodings(args.gallery_size, args.probes, args.identities)
+
+    _, exact_time = timed(api.match_top_k, probes, gallery, k=args.k)
+    print("exact: {:.3f} ms/probe".format(1000 * exact_time / args.probes))
+
+    index, build_time = timed(IVFIndex.build, gallery, nlist=args.nlist, pq_subquantizers=args.pq)
+    print("index: nlist={} pq={} built in {:.1f} s".format(index.nlist, args.pq, build_time))
+
+    for nprobe in args.nprobe:
+        _, search_time = timed(index.search, probes, k=args.k, nprobe=nprobe)
+        recall = recall_at_k(index, probes, gallery, k=args.k, nprobe=nprobe)
+        print("nprobe={:<4d} {:.3f} ms/probe  recall@{}={:.3f}  speedup={:.1f}x".format(
+            nprobe, 1000 * search_time / args.probes, args.k, recall, exact_time / search_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Latency and throughput of the face_recognition.api hot paths on CPU, per
+function and image size, with baseline results to catch regressions.
+
+Test images are generated from a face image (by default the sample
+tmp/testiai/Chandler.jpg of the repository) pasted on backgrounds of several
+sizes, along with a short video of them when OpenCV is installed, and large
+camera-sized JPEGs to time load_image_file with and without max_size. Sizes
+where no face is detected skip the landmarks and encodings cases. Results are
+saved as JSON, and compared against a baseline: cases whose median latency
+grew by more than --threshold are flagged and the script exits with status 1.
+
+    $ python benchmarks/bench_api.py --save-baseline bench_baseline.json
+    $ python benchmarks/bench_api.py --baseline bench_baseline.json --threshold 0.15
+"""
+from __future__ import print_function
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+
+import face_recognition.api as face_recognition
+
+DEFAULT_FACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tmp', 'testiai', 'Chandler.jpg')
+SIZES = {'qvga': (320, 240), 'vga': (640, 480), 'hd': (1280, 720), 'fullhd': (1920, 1080), '12mp': (4032, 3024), '24mp': (6000, 4000)}
+
+
+def synthetic_image(size, face=None, seed=0):
+    """
+    A (height, width, 3) RGB image of the given (width, height) size: smooth
+    random background with the face image pasted in the middle at a third of
+    the image height.
+    """
+    width, height = size
+    rng = np.random.RandomState(seed)
+    background = PIL.Image.fromarray(rng.randint(0, 256, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8))
+    image = background.resize((width, height), PIL.Image.BILINEAR)
+    if face is not None:
+        face_height = height // 3
+        face_width = face_height * face.width // face.height
+        image.paste(face.resize((face_width, face_height), PIL.Image.BILINEAR), ((width - face_width) // 2, (height - face_height) // 2))
+    return np.array(image)
+
+
+def write_video(path, frames, fps=10):
+    """
+    Write frames (RGB) to an MJPG video. Returns False when OpenCV is missing.
+    """
+    try:
+        import cv2
+    except ImportError:
+        return False
+    height, width = frames[0].shape[:2]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    for frame in frames:
+        writer.write(frame[:, :, ::-1])
+    writer.release()
+    return True
+
+
+def measure(function, repeat, warmup=1, items=1):
+    """
+    Run function `warmup` + `repeat` times and return the latency percentiles
+    (ms) and throughput (items per second)
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {
+        'repeat': repeat,
+        'mean_ms': float(times.mean()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+        'per_second': float(items * 1000 / times.mean()),
+    }
+
+
+def cases(args, workdir, face, executors):
+    """
+    Yield (name, callable, items) for every benchmarked function and image size
+
+    executors maps processes=False/True to the thread and process pools reused
+    by the parallel_face_locations cases, so that their start-up isn't timed.
+    """
+    for size_name in args.sizes:
+        image = synthetic_image(SIZES[size_name], face)
+        path = os.path.join(workdir, '{}.jpg'.format(size_name))
+        PIL.Image.fromarray(image).save(path, quality=90)
+        locations = face_recognition.face_locations(image)
+
+        yield 'load_image_file/{}'.format(size_name), lambda path=path: face_recognition.load_image_file(path), 1
+        yield 'face_locations/hog/{}'.format(size_name), lambda image=image: face_recognition.face_locations(image), 1
+        if args.batch:
+            batch = [image] * args.batch
+            for processes in (False, True):
+                yield ('parallel_face_locations/hog/{}/{}'.format('processes' if processes else 'threads', size_name),
+                       lambda batch=batch, processes=processes: list(face_recognition.parallel_face_locations(
+                           batch, processes=processes, executor=executors[processes])),
+                       args.batch)
+        if args.cnn:
+            yield 'face_locations/cnn/{}'.format(size_name), lambda image=image: face_recognition.face_locations(image, model='cnn'), 1
+        if not locations:
+            # Landmarks and encodings of no face at all would only time function call overhead
+            print("WARNING: no face found in the {} test image, skipping its face_landmarks and face_encodings cases".format(size_name))
+            continue
+        for model in ('large', 'small'):
+            yield ('face_landmarks/{}/{}'.format(model, size_name),
+                   lambda image=image, model=model: face_recognition.face_landmarks(image, locations, model), 1)
+        for num_jitters in args.jitters:
+            yield ('face_encodings/jitters{}/{}'.format(num_jitters, size_name),
+                   lambda image=image, num_jitters=num_jitters: face_recognition.face_encodings(image, locations, num_jitters), 1)
+
+    for size_name in args.photo_sizes:
+        path = os.path.join(workdir, 'photo-{}.jpg'.format(size_name))
+        PIL.Image.fromarray(synthetic_image(SIZES[size_name], face)).save(path, quality=92)
+        yield 'load_image_file/photo/{}'.format(size_name), lambda path=path: face_recognition.load_image_file(path), 1
+        for max_size in args.max_sizes:
+            yield ('load_image_file/photo/max{}/{}'.format(max_size, size_name),
+                   lambda path=path, max_size=max_size: face_recognition.load_image_file(path, max_size=max_size), 1)
+
+    rng = np.random.RandomState(0)
+    for known in args.known:
+        encodings = rng.normal(0, 0.09, (known, 128))
+        probe = rng.normal(0, 0.09, 128)
+        yield 'face_distance/{}'.format(known), lambda encodings=encodings, probe=probe: face_recognition.face_distance(encodings, probe), known
+
+    frames = [synthetic_image(SIZES['vga'], face, seed) for seed in range(args.video_frames)]
+    video_path = os.path.join(workdir, 'video.avi')
+    if args.video_frames and write_video(video_path, frames):
+        import cv2
+
+        def video():
+            capture = cv2.VideoCapture(video_path)
+            while True:
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                face_recognition.face_locations(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            capture.release()
+        yield 'video/decode+face_locations/vga', video, args.video_frames
+
+
+def environment():
+    try:
+        import dlib
+        dlib_version = dlib.__version__
+    except (ImportError, AttributeError):
+        dlib_version = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'dlib': dlib_version,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Return the cases whose median latency grew by more than threshold (0.1 =
+    10%) compared to the baseline, as (name, baseline ms, current ms)
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is not None and result['p50_ms'] > reference['p50_ms'] * (1 + threshold):
+            regressions.append((name, reference['p50_ms'], result['p50_ms']))
+    return regressions
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--face', default=DEFAULT_FACE, help="image of a face pasted in the test images (default: %(default)s)")
+    p.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['qvga', 'vga', 'hd'])
+    p.add_argument('--photo-sizes', nargs='*', choices=sorted(SIZES), default=['12mp', '24mp'],
+                   help="sizes of the camera JPEGs decoded by load_image_file")
+    p.add_argument('--max-sizes', type=int, nargs='*', default=[1600, 800], help="load_image_file max_size values to time on them")
+    p.add_argument('--jitters', type=int, nargs='+', default=[1, 10])
+    p.add_argument('--known', type=int, nargs='+', default=[100, 10000])
+    p.add_argument('--batch', type=int, default=16, help="images per parallel_face_locations call (0 = skip)")
+    p.add_argument('--cnn', action='store_true', help="also benchmark the CNN detector (slow without a GPU)")
+    p.add_argument('--video-frames', type=int, default=20)
+    p.add_argument('--repeat', type=int, default=10)
+    p.add_argument('--output', help="save the results to this JSON file")
+    p.add_argument('--save-baseline', help="save the results as the baseline in this JSON file")
+    p.add_argument('--baseline', help="compare the results with this baseline JSON file")
+    p.add_argument('--threshold', type=float, default=0.15, help="median latency increase flagged as a regression")
+    args = p.parse_args()
+
+    face = PIL.Image.open(args.face).convert('RGB')
+    workdir = tempfile.mkdtemp(prefix='bench-api-')
+    workers = os.cpu_count() or 1
+    executors = {
+        False: ThreadPoolExecutor(workers),
+        True: ProcessPoolExecutor(workers, initializer=face_recognition.preload, initargs=(['face_detector'],)),
+    }
+    results = {}
+    try:
+        print("{:<40} {:>10} {:>10} {:>10} {:>12}".format("case", "p50 ms", "p90 ms", "p99 ms", "per second"))
+        for name, function, items in cases(args, workdir, face, executors):
+            results[name] = measure(function, args.repeat, items=items)
+            print("{:<40} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+                name, results[name]['p50_ms'], results[name]['p90_ms'], results[name]['p99_ms'], results[name]['per_second']))
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+        shutil.rmtree(workdir)
+
+    report = {'environment': environment(), 'results': results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != report['environment']:
+            print("WARNING: the baseline was measured on another environment: {}".format(baseline['environment']))
+        regressions = compare(results, baseline['results'], args.threshold)
+        for name, before, after in regressions:
+            print("REGRESSION {}: p50 {:.2f} ms -> {:.2f} ms (+{:.0%})".format(name, before, after, after / before - 1))
+        if regressions:
+            raise SystemExit(1)
+        print("No regression above {:.0%} against {}".format(args.threshold, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput (MB/s) of AnalyticsAgent.write_output / read_input on plaintext and
+encrypted datalakes, for each cipher.
+
+  $ python benchmarks/bench_datalake.py --size-mb 256 --ciphers AES-256-GCM CHACHA20-POLY1305
+"""
+from __future__ import print_function
+import base64
+import os
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from iai_toolbox import AnalyticsAgent, AnalyticsRequest
+
+
+class _Agent(AnalyticsAgent):
+    def __init__(self, datalake, cipher):
+        params = AnalyticsRequest()
+        params.iai_datalake = datalake
+        params.iai_datacipher = cipher
+        params.iai_datakey = base64.b64encode(os.urandom(32)).decode('ascii') if cipher else None
+        super(_Agent, self).__init__(params)
+
+
+def _throughput(size, run, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return size / best / 1e6
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('--size-mb', type=int, default=128)
+    p.add_argument('--ciphers', nargs='+', default=['AES-256-GCM', 'CHACHA20-POLY1305'])
+    p.add_argument('--repeat', type=int, default=3)
+    args = p.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    payload = os.urandom(1024 * 1024)
+    datalake = tempfile.mkdtemp(prefix='bench-datalake-')
+
+    try:
+        print("{:>20} {:>12} {:>12} {:>12}".format("cipher", "write MB/s", "read MB/s", "mmap MB/s"))
+        for cipher in [None] + args.ciphers:
+            agent = _Agent(datalake, cipher)
+
+            def write():
+                with agent.open_output('data') as f:
+                    for _ in range(args.size_mb):
+                        f.write(payload)
+
+            def read():
+                for _ in agent.read_input('data', mode='chunks'):
+                    pass
+
+            def read_mmap():
+                m = agent.read_input('data', mode='mmap')
+                for offset in range(0, len(m), len(payload)):
+                    m[offset:offset + len(payload)]
+                m.close()
+                agent.release_inputs()
+
+            print("{:>20} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                cipher or "plaintext", _throughput(size, write, args.repeat), _throughput(size, read, args.repeat),
+                _throughput(size, read_mmap, args.repeat)))
+    finally:
+        shutil.rmtree(datalake)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Speed versus recall of face_locations(detection_scale=...) on a folder of
+images. Recall is measured against the faces found at full resolution (a
+face counts as found when a box overlaps it with IoU >= 0.5).
+
+  $ python benchmarks/bench_detection_scale.py ./tmp/testiai --scales 1 0.75 0.5 0.25
+"""
+from __future__ import print_function
+import time
+from argparse import ArgumentParser
+
+import face_recognition.api as face_recognition
+from face_recognition.crawl import image_files
+from face_recognition.tracking import _iou
+
+
+def main():
+    p = ArgumentParser()
+    p.add_argument('folder')
+    p.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.75, 0.5, 0.25])
+    p.add_argument('--model', default='hog')
+    p.add_argument('--upsample', type=int, default=1)
+    p.add_argument('--repeat', type=int, default=3)
+    args = p.parse_args()
+
+    images = [face_recognition.load_image_file(f) for f in image_files(args.folder)]
+    print("{} images, model={}, upsample={}".format(len(images), args.model, args.upsample))
+
+    reference = [face_recognition.face_locations(image, args.upsample, args.model) for image in images]
+    total_faces = sum(len(faces) for faces in reference)
+
+    print("{:>6} {:>12} {:>8} {:>8}".format("scale", "ms/image", "recall", "speedup"))
+    baseline = None
+    for scale in args.scales:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            found = [face_recognition.face_locations(image, args.upsample, args.model, detection_scale=scale) for image in images]
+        elapsed = (time.perf_counter() - start) / (args.repeat * max(1, len(images)))
+        baseline = baseline or elapsed
+
+        matched = sum(
+            1 for expected, faces in zip(reference, found) for face in expected
+            if any(_iou(face, other) >= 0.5 for other in faces)
+        )
+        recall = matched / float(total_faces) if total_faces else 1.0
+        print("{:>6.2f} {:>12.1f} {:>8.3f} {:>7.1f}x".format(scale, 1000 * elapsed, recall, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the wall time and peak RSS of importing face_recognition.api in a fresh
+interpreter, alone and followed by loading some or all of the dlib models.
+
+  $ python benchmarks/bench_import.py
+"""
+from __future__ import print_function
+import json
+import subprocess
+import sys
+
+SCENARIOS = [
+    ("import only", None),
+    ("import + HOG detector", ["face_detector"]),
+    ("import + server models", ["face_detector", "pose_predictor_5_point", "face_encoder"]),
+    ("import + preload all", "all"),
+]
+
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+import face_recognition.api as api
+imported = time.perf_counter()
+models = json.loads(sys.argv[1])
+if models is not None:
+    api.preload(None if models == "all" else models)
+loaded = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - start,
+    "load_s": loaded - imported,
+    "maxrss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+}))
+"""
+
+
+def measure(models, repeat=3):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", CHILD, json.dumps(models)])
+        runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    # Keep the fastest run: the others mostly measure a cold page cache
+    return min(runs, key=lambda run: run["import_s"] + run["load_s"])
+
+
+def main():
+    print("{:<26} {:>10} {:>10} {:>12}".format("scenario", "import s", "load s", "max RSS MB"))
+    for name, models in SCENARIOS:
+        run = measure(models)
+        print("{:<26} {:>10.3f} {:>10.3f} {:>12.1f}".format(name, run["import_s"], run["load_s"], run["maxrss_mb"]))
+
+
+if __name__ == '__main__':
+    main()
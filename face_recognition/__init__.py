@@ -4,4 +4,4 @@ __author__ = """Adam Geitgey"""
 __email__ = 'ageitgey@gmail.com'
 __version__ = '1.2.3'
 
-from .api import load_image_file, face_locations, batch_face_locations, face_landmarks, face_encodings, compare_faces, face_distance
+from .api import load_image_file, face_locations, batch_face_locations, parallel_face_locations, face_landmarks, face_encodings, analyze_faces, compare_faces, face_distance, face_distance_matrix, match_top_k, squared_norms, preload
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+
+import numpy as np
+
+from . import api
+
+INDEX_VERSION = 1
+
+
+def _kmeans(data, k, n_iter=20, seed=0):
+    """
+    Plain Lloyd's k-means clustering
+
+    :param data: (N, D) numpy array of points to cluster
+    :param k: number of clusters
+    :param n_iter: number of assignment / update iterations
+    :param seed: seed of the random initialization
+    :return: a (k, D) numpy array of centroids
+    """
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = api.match_top_k(data, centroids, k=1)[0][:, 0]
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        # Restart empty clusters from random points so every list stays useful
+        if empty.any():
+            centroids[empty] = data[rng.choice(len(data), empty.sum(), replace=False)]
+
+    return centroids
+
+
+def encodings_fingerprint(face_encodings):
+    """
+    Compute a digest of a face encodings matrix, used to tell whether an index was built from it
+
+    :param face_encodings: A list of face encodings
+    :return: hex digest of the encodings
+    """
+    face_encodings = np.ascontiguousarray(face_encodings, dtype=np.float64)
+    digest = hashlib.sha1(str(face_encodings.shape).encode('ascii'))
+    digest.update(face_encodings.data)
+    return digest.hexdigest()
+
+
+class IVFIndex(object):
+    """
+    An approximate nearest neighbour index over face encodings, for 1:N identification against large galleries.
+
+    Encodings are split into `nlist` inverted lists by a k-means coarse quantizer. A query only scans the `nprobe` lists
+    whose centroids are closest to it: higher `nprobe` means better recall but slower queries, and `nprobe == nlist`
+    is an exact search.
+
+    With `pq_subquantizers` > 0, the lists store product quantization codes of the residuals (encoding minus centroid)
+    instead of the encodings themselves: each encoding takes `pq_subquantizers` bytes instead of 1KB, and distances
+    are approximated with per-query lookup tables.
+    """
+
+    def __init__(self, centroids, offsets, ids, vectors=None, codebooks=None, codes=None, fingerprint=""):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.codebooks = codebooks
+        self.codes = codes
+        self.fingerprint = fingerprint
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, face_encodings, nlist=None, pq_subquantizers=0, n_iter=20, max_training_points=None, seed=0):
+        """
+        Build an index over a gallery of face encodings
+
+        :param face_encodings: A list of M known face encodings. Search results refer to their position in this list.
+        :param nlist: Optional - number of inverted lists. Defaults to 4 * sqrt(M).
+        :param pq_subquantizers: Optional - number of product quantization bytes per encoding. Must divide the encoding
+                                 size (128). The default, 0, stores the encodings uncompressed.
+        :param n_iter: number of k-means iterations used to train the quantizers
+        :param max_training_points: Optional - train the quantizers on a random sample of this many encodings.
+                                    Defaults to 256 points per list.
+        :param seed: seed of the random sampling and k-means initialization
+        :return: an IVFIndex
+        """
+        data = api._as_encoding_matrix(face_encodings)
+        if len(data) == 0:
+            raise ValueError("Can't build an index without any face encodings")
+
+        if nlist is None:
+            nlist = int(4 * np.sqrt(len(data)))
+        nlist = max(1, min(nlist, len(data)))
+
+        if max_training_points is None:
+            max_training_points = 256 * nlist
+
+        rng = np.random.RandomState(seed)
+        training = data
+        if len(data) > max_training_points:
+            training = data[rng.choice(len(data), max_training_points, replace=False)]
+
+        centroids = _kmeans(training, nlist, n_iter, seed)
+        assignment = api.match_top_k(data, centroids, k=1)[0][:, 0]
+
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+
+        index = cls(centroids, offsets, ids, fingerprint=encodings_fingerprint(data))
+
+        if not pq_subquantizers:
+            index.vectors = data[ids]
+            return index
+
+        if data.shape[1] % pq_subquantizers:
+            raise ValueError("pq_subquantizers must divide the encoding size ({})".format(data.shape[1]))
+
+        residuals = data[ids] - centroids[assignment[ids]]
+        subvectors = residuals.reshape(len(data), pq_subquantizers, -1)
+        ksub = min(256, len(data))
+        # 64 points per sub-centroid are plenty to train 256-entry codebooks in a few dimensions
+        training_rows = rng.choice(len(data), min(len(data), 64 * ksub), replace=False)
+
+        index.codebooks = np.stack([
+            _kmeans(subvectors[training_rows, m], ksub, n_iter, seed) for m in range(pq_subquantizers)
+        ])
+        index.codes = np.stack([
+            api.match_top_k(subvectors[:, m], index.codebooks[m], k=1)[0][:, 0] for m in range(pq_subquantizers)
+        ], axis=1).astype(np.uint8)
+        return index
+
+    def _list_distances(self, probes, list_number):
+        start, stop = self.offsets[list_number], self.offsets[list_number + 1]
+        if self.codes is None:
+            return api.face_distance_matrix(probes, self.vectors[start:stop])
+
+        # Asymmetric distance: for each probe, a (subquantizers, 256) table of squared distances between the probe
+        # residual's sub-vectors and every centroid of the matching sub-codebook, summed over each code
+        pq_subquantizers = self.codebooks.shape[0]
+        residuals = (probes - self.centroids[list_number]).reshape(len(probes), pq_subquantizers, 1, -1)
+        tables = ((self.codebooks - residuals) ** 2).sum(axis=3)
+        squared = tables[:, np.arange(pq_subquantizers), self.codes[start:stop]].sum(axis=2)
+        return np.sqrt(squared)
+
+    def search(self, probe_encodings, k=1, nprobe=8):
+        """
+        Find the (approximately) k closest known faces for each probe face encoding
+
+        :param probe_encodings: A list of N face encodings to identify
+        :param k: How many matches to return per probe
+        :param nprobe: How many inverted lists to scan per probe. Higher is more accurate, but slower.
+        :return: A tuple of two (N, k) numpy ndarrays: the indices of the matching known faces and their distances,
+                 closest first. When fewer than k faces were scanned, missing entries have index -1 and distance inf.
+        """
+        probes = api._as_encoding_matrix(probe_encodings)
+        nprobe = max(1, min(nprobe, self.nlist))
+
+        indices = np.full((len(probes), k), -1, dtype=np.intp)
+        distances = np.full((len(probes), k), np.inf)
+        if len(probes) == 0 or k == 0:
+            return indices, distances
+
+        probed_lists = api.match_top_k(probes, self.centroids, k=nprobe)[0]
+
+        # Scan list by list so that all the probes visiting a list share one distance computation, and merge the
+        # results into the running top k of those probes
+        for list_number in np.unique(probed_lists):
+            start, stop = self.offsets[list_number], self.offsets[list_number + 1]
+            if start == stop:
+                continue
+
+            rows = np.nonzero((probed_lists == list_number).any(axis=1))[0]
+            list_distances = self._list_distances(probes[rows], list_number)
+
+            candidate_distances = np.concatenate([distances[rows], list_distances], axis=1)
+            candidate_ids = np.concatenate([indices[rows], np.broadcast_to(self.ids[start:stop], list_distances.shape)], axis=1)
+            best = np.argpartition(candidate_distances, k - 1, axis=1)[:, :k]
+            distances[rows] = np.take_along_axis(candidate_distances, best, axis=1)
+            indices[rows] = np.take_along_axis(candidate_ids, best, axis=1)
+
+        order = np.argsort(distances, axis=1)
+        return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def _arrays(self):
+        arrays = {
+            "version": np.array(INDEX_VERSION),
+            "fingerprint": np.array(self.fingerprint),
+            "centroids": self.centroids,
+            "offsets": self.offsets,
+            "ids": self.ids,
+        }
+        if self.codes is None:
+            arrays["vectors"] = self.vectors
+        else:
+            arrays["codebooks"] = self.codebooks
+            arrays["codes"] = self.codes
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, data, path):
+        if int(data["version"]) != INDEX_VERSION:
+            raise ValueError("Unsupported index version {} in {}".format(int(data["version"]), path))
+
+        return cls(
+            data["centroids"], data["offsets"], data["ids"],
+            vectors=data["vectors"] if "vectors" in data else None,
+            codebooks=data["codebooks"] if "codebooks" in data else None,
+            codes=data["codes"] if "codes" in data else None,
+            fingerprint=str(data["fingerprint"]),
+        )
+
+    def save(self, path):
+        """
+        Write the index to a .npz file
+
+        :param path: file name to write to
+        """
+        tmp_path = "{}.{}.tmp.npz".format(path, os.getpid())
+        np.savez(tmp_path, **self._arrays())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by `save`
+
+        :param path: file name to read from
+        :return: an IVFIndex
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls._from_arrays(data, path)
+
+    def save_arrays(self, directory):
+        """
+        Write the index as one .npy file per array in a directory, which `load_arrays` can memory-map. Used to share
+        an index between processes without each of them holding a copy.
+
+        :param directory: directory to write to, created if missing
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self._arrays().items():
+            np.save(os.path.join(directory, name + ".npy"), array)
+
+    @classmethod
+    def load_arrays(cls, directory, mmap_mode=None):
+        """
+        Read an index written by `save_arrays`
+
+        :param directory: directory to read from
+        :param mmap_mode: Optional - 'r' to memory-map the arrays instead of reading them
+        :return: an IVFIndex
+        """
+        data = {}
+        for filename in os.listdir(directory):
+            if filename.endswith(".npy"):
+                data[filename[:-len(".npy")]] = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode, allow_pickle=False)
+        return cls._from_arrays(data, directory)
+
+
+def load_or_build_index(path, face_encodings, **build_options):
+    """
+    Load an index from disk, or (re)build and save it if it is missing or was built from other face encodings
+
+    :param path: file name of the saved index
+    :param face_encodings: A list of known face encodings the index must cover
+    :param build_options: Optional - keyword arguments of `IVFIndex.build`
+    :return: an IVFIndex
+    """
+    if os.path.exists(path):
+        index = IVFIndex.load(path)
+        if index.fingerprint == encodings_fingerprint(face_encodings):
+            return index
+
+    index = IVFIndex.build(face_encodings, **build_options)
+    index.save(path)
+    return index
+
+
+def recall_at_k(index, probe_encodings, known_face_encodings, k=10, nprobe=8):
+    """
+    Measure how many of the true k nearest known faces an index finds, compared to an exact search
+
+    :param index: the IVFIndex to evaluate
+    :param probe_encodings: A list of face encodings to query with
+    :param known_face_encodings: the known face encodings the index was built from
+    :param k: number of neighbours to compare
+    :param nprobe: the `nprobe` search parameter to evaluate
+    :return: the average fraction of the exact top k found in the approximate top k, between 0 and 1
+    """
+    exact = api.match_top_k(probe_encodings, known_face_encodings, k=k)[0]
+    approximate = index.search(probe_encodings, k=k, nprobe=nprobe)[0]
+    found = [len(np.intersect1d(e, a)) for e, a in zip(exact, approximate)]
+    return float(np.mean(found)) / exact.shape[1] if len(found) else 1.0
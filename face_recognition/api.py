@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import PIL.Image
 import dlib
 import numpy as np
@@ -12,19 +17,74 @@ except Exception:
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-face_detector = dlib.get_frontal_face_detector()
+# dlib models are only deserialized the first time they are used (see `preload` to load them up front)
+_MODEL_LOADERS = {
+    "face_detector": lambda: dlib.get_frontal_face_detector(),
+    "pose_predictor_68_point": lambda: dlib.shape_predictor(face_recognition_models.pose_predictor_model_location()),
+    "pose_predictor_5_point": lambda: dlib.shape_predictor(face_recognition_models.pose_predictor_five_point_model_location()),
+    "cnn_face_detector": lambda: dlib.cnn_face_detection_model_v1(face_recognition_models.cnn_face_detector_model_location()),
+    "face_encoder": lambda: dlib.face_recognition_model_v1(face_recognition_models.face_recognition_model_location()),
+}
+MODEL_NAMES = tuple(_MODEL_LOADERS)
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _load_model(name):
+    """
+    Return one of the dlib models, deserializing it on first use
+
+    :param name: one of MODEL_NAMES
+    :return: the dlib model object
+    """
+    model = _models.get(name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(name)
+            if model is None:
+                model = _models[name] = _MODEL_LOADERS[name]()
+    return model
+
+
+_thread_models = threading.local()
 
-predictor_68_point_model = face_recognition_models.pose_predictor_model_location()
-pose_predictor_68_point = dlib.shape_predictor(predictor_68_point_model)
 
-predictor_5_point_model = face_recognition_models.pose_predictor_five_point_model_location()
-pose_predictor_5_point = dlib.shape_predictor(predictor_5_point_model)
+def _load_thread_model(name):
+    """
+    Return one of the dlib models, loaded once per thread. dlib detectors keep scratch state and can't be shared by
+    threads running detection at the same time.
 
-cnn_face_detection_model = face_recognition_models.cnn_face_detector_model_location()
-cnn_face_detector = dlib.cnn_face_detection_model_v1(cnn_face_detection_model)
+    :param name: one of MODEL_NAMES
+    :return: the dlib model object
+    """
+    models = getattr(_thread_models, "models", None)
+    if models is None:
+        models = _thread_models.models = {}
+    model = models.get(name)
+    if model is None:
+        model = models[name] = _MODEL_LOADERS[name]()
+    return model
 
-face_recognition_model = face_recognition_models.face_recognition_model_location()
-face_encoder = dlib.face_recognition_model_v1(face_recognition_model)
+
+def preload(models=None):
+    """
+    Load dlib models now instead of on first use. Useful for servers that want the first request to be fast, or
+    to load models once in a parent process before forking workers.
+
+    :param models: Optional - a list of model names to load, from MODEL_NAMES. Defaults to all of them.
+    """
+    for name in MODEL_NAMES if models is None else models:
+        if name not in _MODEL_LOADERS:
+            raise ValueError("Invalid model name {}. Supported models are {}.".format(name, list(MODEL_NAMES)))
+        _load_model(name)
+
+
+def __getattr__(name):
+    # Keep the module level model attributes (face_recognition.api.face_detector, ...) working
+    if name in _MODEL_LOADERS:
+        return _load_model(name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def _rect_to_css(rect):
@@ -73,21 +133,155 @@ def face_distance(face_encodings, face_to_compare):
     return np.linalg.norm(face_encodings - face_to_compare, axis=1)
 
 
-def load_image_file(file, mode='RGB'):
+# Upper bound on the number of probe x known distances held in memory at once (128MB of float64)
+_DISTANCE_CHUNK_ELEMENTS = 1 << 24
+
+
+def _as_encoding_matrix(encodings):
+    """
+    Convert a list (or array) of face encodings to a 2d float64 numpy array without copying arrays that already are
+
+    :param encodings: A list of face encodings, or a single face encoding
+    :return: A numpy ndarray with one face encoding per row
+    """
+    encodings = np.asarray(encodings, dtype=np.float64)
+    if encodings.ndim == 1:
+        encodings = encodings.reshape(1, -1) if encodings.size else encodings.reshape(0, 128)
+    return encodings
+
+
+def squared_norms(face_encodings):
+    """
+    Compute the squared euclidean norm of each face encoding. Pass the result as `known_squared_norms` to
+    `face_distance_matrix` or `match_top_k` to avoid recomputing it on every call with the same known faces.
+
+    :param face_encodings: A list of face encodings
+    :return: A numpy ndarray with the squared norm of each face encoding
+    """
+    face_encodings = _as_encoding_matrix(face_encodings)
+    return np.einsum('ij,ij->i', face_encodings, face_encodings)
+
+
+def _distance_chunks(probe_encodings, known_face_encodings, known_squared_norms=None, chunk_size=None):
+    """
+    Yield euclidean distances between probes and known faces, a block of probes at a time.
+
+    Distances are computed as sqrt(|p|^2 - 2 p.k + |k|^2) so that each block costs a single matrix product.
+
+    :return: A generator of (start, distances) tuples where distances is a (block size, M) ndarray for probes[start:start + block size]
+    """
+    probes = _as_encoding_matrix(probe_encodings)
+    known = _as_encoding_matrix(known_face_encodings)
+
+    if known_squared_norms is None:
+        known_squared_norms = squared_norms(known)
+
+    if chunk_size is None:
+        chunk_size = max(1, _DISTANCE_CHUNK_ELEMENTS // max(1, len(known)))
+
+    for start in range(0, len(probes), chunk_size):
+        block = probes[start:start + chunk_size]
+        distances = block @ known.T
+        distances *= -2
+        distances += known_squared_norms
+        distances += squared_norms(block)[:, np.newaxis]
+        # Rounding can make distances between (nearly) identical encodings slightly negative
+        np.maximum(distances, 0, out=distances)
+        np.sqrt(distances, out=distances)
+        yield start, distances
+
+
+def face_distance_matrix(probe_encodings, known_face_encodings, known_squared_norms=None, chunk_size=None):
+    """
+    Given N probe face encodings and M known face encodings, get the euclidean distance between every probe
+    and every known face. This is equivalent to calling `face_distance` once per probe, but much faster.
+
+    :param probe_encodings: A list of N face encodings to compare
+    :param known_face_encodings: A list of M known face encodings to compare against
+    :param known_squared_norms: Optional - the result of `squared_norms(known_face_encodings)` if you already have it
+    :param chunk_size: Optional - how many probes to compare per block. Defaults to a block size that bounds temporary memory.
+    :return: A (N, M) numpy ndarray where row i holds the distances of probe i to each known face
+    """
+    probes = _as_encoding_matrix(probe_encodings)
+    known = _as_encoding_matrix(known_face_encodings)
+
+    result = np.empty((len(probes), len(known)))
+    if len(probes) == 0 or len(known) == 0:
+        return result
+
+    for start, distances in _distance_chunks(probes, known, known_squared_norms, chunk_size):
+        result[start:start + len(distances)] = distances
+
+    return result
+
+
+def match_top_k(probe_encodings, known_face_encodings, k=1, known_squared_norms=None, chunk_size=None):
+    """
+    Find the k closest known faces for each probe face encoding.
+
+    Only one block of distances is held in memory at a time, so this works with galleries that are too large for a full
+    `face_distance_matrix`.
+
+    :param probe_encodings: A list of N face encodings to identify
+    :param known_face_encodings: A list of M known face encodings to search
+    :param k: How many matches to return per probe. Limited to M.
+    :param known_squared_norms: Optional - the result of `squared_norms(known_face_encodings)` if you already have it
+    :param chunk_size: Optional - how many probes to compare per block. Defaults to a block size that bounds temporary memory.
+    :return: A tuple of two (N, k) numpy ndarrays: the indices of the matching known faces and their distances, closest first
+    """
+    probes = _as_encoding_matrix(probe_encodings)
+    known = _as_encoding_matrix(known_face_encodings)
+    k = min(k, len(known))
+
+    indices = np.empty((len(probes), k), dtype=np.intp)
+    top_distances = np.empty((len(probes), k))
+    if len(probes) == 0 or k == 0:
+        return indices, top_distances
+
+    for start, distances in _distance_chunks(probes, known, known_squared_norms, chunk_size):
+        if k < distances.shape[1]:
+            candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(k), (len(distances), k))
+        candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1)
+
+        stop = start + len(distances)
+        indices[start:stop] = np.take_along_axis(candidates, order, axis=1)
+        top_distances[start:stop] = np.take_along_axis(candidate_distances, order, axis=1)
+
+    return indices, top_distances
+
+
+def load_image_file(file, mode='RGB', max_size=None):
     """
     Loads an image file (.jpg, .png, etc) into a numpy array
 
     :param file: image file name or file object to load
     :param mode: format to convert the image to. Only 'RGB' (8-bit RGB, 3 channels) and 'L' (black and white) are supported.
+    :param max_size: Optional - scale the image down, keeping its aspect ratio, so that neither side is larger than this.
+                     JPEG images are decoded directly at (up to 8 times) reduced size, which is much faster than
+                     decoding them whole for large photos.
     :return: image contents as numpy array
     """
     im = PIL.Image.open(file)
-    if mode:
+
+    size = None
+    if max_size is not None and max(im.size) > max_size:
+        scale = max_size / max(im.size)
+        size = (max(1, int(round(im.width * scale))), max(1, int(round(im.height * scale))))
+        # Only does something on JPEG images: decode with the strongest DCT scaling (1/2, 1/4, 1/8) keeping at least `size`
+        im.draft(mode, size)
+
+    # convert() copies the image even when it is already in the right mode
+    if mode and im.mode != mode:
         im = im.convert(mode)
+    if size is not None and im.size != size:
+        im = im.resize(size, PIL.Image.BILINEAR)
     return np.array(im)
 
 
-def _raw_face_locations(img, number_of_times_to_upsample=1, model="hog"):
+def _raw_face_locations(img, number_of_times_to_upsample=1, model="hog", load_model=_load_model):
     """
     Returns an array of bounding boxes of human faces in a image
 
@@ -95,15 +289,57 @@ def _raw_face_locations(img, number_of_times_to_upsample=1, model="hog"):
     :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
     :param model: Which face detection model to use. "hog" is less accurate but faster on CPUs. "cnn" is a more accurate
                   deep-learning model which is GPU/CUDA accelerated (if available). The default is "hog".
+    :param load_model: how to get the detector (`_load_model`, or `_load_thread_model` from threads running in parallel)
     :return: A list of dlib 'rect' objects of found face locations
     """
     if model == "cnn":
-        return cnn_face_detector(img, number_of_times_to_upsample)
+        return load_model("cnn_face_detector")(img, number_of_times_to_upsample)
     else:
-        return face_detector(img, number_of_times_to_upsample)
+        return load_model("face_detector")(img, number_of_times_to_upsample)
+
+
+def _downscale(img, scale):
+    """
+    Resize an image by a factor lower than 1
+
+    :param img: An image (as a numpy array)
+    :param scale: the resize factor
+    :return: the resized image as a numpy array
+    """
+    height, width = img.shape[:2]
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return np.asarray(PIL.Image.fromarray(img).resize(size, PIL.Image.BILINEAR))
+
+
+def _scale_rect(rect, factor):
+    return dlib.rectangle(int(round(rect.left() * factor)), int(round(rect.top() * factor)),
+                          int(round(rect.right() * factor)), int(round(rect.bottom() * factor)))
 
 
-def face_locations(img, number_of_times_to_upsample=1, model="hog"):
+def _raw_face_rects(img, number_of_times_to_upsample=1, model="hog", detection_scale=1.0, load_model=_load_model):
+    """
+    Returns the dlib rects of the faces in an image, optionally detected on a downscaled copy of it
+
+    :param img: An image (as a numpy array)
+    :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
+    :param model: Which face detection model to use, "hog" or "cnn"
+    :param detection_scale: Run detection on a copy of the image resized by this factor. The rects are mapped back to
+                            the coordinates of `img`.
+    :param load_model: how to get the detector, see `_raw_face_locations`
+    :return: A list of dlib 'rect' objects of found face locations
+    """
+    detection_img = img if detection_scale >= 1.0 else _downscale(img, detection_scale)
+    detections = _raw_face_locations(detection_img, number_of_times_to_upsample, model, load_model)
+    rects = [face.rect for face in detections] if model == "cnn" else list(detections)
+
+    if detection_img is not img:
+        factor = img.shape[1] / float(detection_img.shape[1])
+        rects = [_scale_rect(rect, factor) for rect in rects]
+
+    return rects
+
+
+def face_locations(img, number_of_times_to_upsample=1, model="hog", detection_scale=1.0):
     """
     Returns an array of bounding boxes of human faces in a image
 
@@ -111,12 +347,11 @@ def face_locations(img, number_of_times_to_upsample=1, model="hog"):
     :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
     :param model: Which face detection model to use. "hog" is less accurate but faster on CPUs. "cnn" is a more accurate
                   deep-learning model which is GPU/CUDA accelerated (if available). The default is "hog".
+    :param detection_scale: Optional - run detection on a copy of the image downscaled by this factor (eg. 0.5), which
+                            is faster but misses small faces. Locations are still returned in `img` coordinates.
     :return: A list of tuples of found face locations in css (top, right, bottom, left) order
     """
-    if model == "cnn":
-        return [_trim_css_to_bounds(_rect_to_css(face.rect), img.shape) for face in _raw_face_locations(img, number_of_times_to_upsample, "cnn")]
-    else:
-        return [_trim_css_to_bounds(_rect_to_css(face), img.shape) for face in _raw_face_locations(img, number_of_times_to_upsample, model)]
+    return [_trim_css_to_bounds(_rect_to_css(rect), img.shape) for rect in _raw_face_rects(img, number_of_times_to_upsample, model, detection_scale)]
 
 
 def _raw_face_locations_batched(images, number_of_times_to_upsample=1, batch_size=128):
@@ -127,38 +362,102 @@ def _raw_face_locations_batched(images, number_of_times_to_upsample=1, batch_siz
     :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
     :return: A list of dlib 'rect' objects of found face locations
     """
-    return cnn_face_detector(images, number_of_times_to_upsample, batch_size=batch_size)
+    return _load_model("cnn_face_detector")(images, number_of_times_to_upsample, batch_size=batch_size)
 
 
 def batch_face_locations(images, number_of_times_to_upsample=1, batch_size=128):
     """
     Returns an 2d array of bounding boxes of human faces in a image using the cnn face detector
     If you are using a GPU, this can give you much faster results since the GPU
-    can process batches of images at once. If you aren't using a GPU, you don't need this function.
+    can process batches of images at once. If you aren't using a GPU, see `parallel_face_locations` instead.
+
+    Images of different sizes are batched separately, by size.
 
     :param images: A list of images (each as a numpy array)
     :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
     :param batch_size: How many images to include in each GPU processing batch.
     :return: A list of tuples of found face locations in css (top, right, bottom, left) order
     """
-    def convert_cnn_detections_to_css(detections):
-        return [_trim_css_to_bounds(_rect_to_css(face.rect), images[0].shape) for face in detections]
+    # The CNN detector only runs batches of images of the same size
+    indices_by_shape = collections.OrderedDict()
+    for i, image in enumerate(images):
+        indices_by_shape.setdefault(image.shape, []).append(i)
 
-    raw_detections_batched = _raw_face_locations_batched(images, number_of_times_to_upsample, batch_size)
+    locations = [None] * len(images)
+    for shape, indices in indices_by_shape.items():
+        raw_detections_batched = _raw_face_locations_batched([images[i] for i in indices], number_of_times_to_upsample, batch_size)
+        for i, detections in zip(indices, raw_detections_batched):
+            locations[i] = [_trim_css_to_bounds(_rect_to_css(face.rect), shape) for face in detections]
 
-    return list(map(convert_cnn_detections_to_css, raw_detections_batched))
+    return locations
 
 
-def _raw_face_landmarks(face_image, face_locations=None, model="large"):
+def _thread_face_locations(img, number_of_times_to_upsample, model, detection_scale):
+    rects = _raw_face_rects(img, number_of_times_to_upsample, model, detection_scale, load_model=_load_thread_model)
+    return [_trim_css_to_bounds(_rect_to_css(rect), img.shape) for rect in rects]
+
+
+def parallel_face_locations(images, number_of_times_to_upsample=1, model="hog", workers=None, processes=False,
+                            detection_scale=1.0, max_pending=None, executor=None):
+    """
+    Detect the faces of many images at once on the CPU cores, with the "hog" or "cnn" model. Results are yielded in
+    the order of the images, as soon as they are ready.
+
+    By default images are spread over threads, which run detection in parallel since dlib releases the GIL, each
+    with its own detector. With processes=True they are sent to worker processes instead, which costs pickling the
+    images but also runs the Python parts of detection in parallel.
+
+    :param images: An iterable of images (each as a numpy array), of any sizes. It is consumed lazily, so it can
+                   eg. load images from files one at a time.
+    :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
+    :param model: Which face detection model to use, "hog" or "cnn"
+    :param workers: number of threads or processes. Defaults to the number of CPUs.
+    :param processes: Use worker processes instead of threads
+    :param detection_scale: Optional - run detection on copies of the images downscaled by this factor, see `face_locations`
+    :param max_pending: Optional - how many images can be submitted ahead of the one being yielded. Defaults to 2 per worker.
+    :param executor: Optional - an existing ThreadPoolExecutor or ProcessPoolExecutor (matching `processes`) to reuse
+                     across calls, instead of starting `workers` new ones
+    :return: A generator of lists of tuples of found face locations in css (top, right, bottom, left) order, one per image
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    task = face_locations if processes else _thread_face_locations
+    owned_executor = executor is None
+    if owned_executor and processes:
+        detector = "cnn_face_detector" if model == "cnn" else "face_detector"
+        executor = ProcessPoolExecutor(workers, initializer=preload, initargs=([detector],))
+    elif owned_executor:
+        executor = ThreadPoolExecutor(workers)
+
+    pending = collections.deque()
+    try:
+        for image in images:
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+            pending.append(executor.submit(task, image, number_of_times_to_upsample, model, detection_scale))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned_executor:
+            executor.shutdown(wait=True)
+
+
+def _pose_predictor(model="large"):
+    if model == "small":
+        return _load_model("pose_predictor_5_point")
+    else:
+        return _load_model("pose_predictor_68_point")
+
+
+def _raw_face_landmarks(face_image, face_locations=None, model="large", detection_scale=1.0):
     if face_locations is None:
-        face_locations = _raw_face_locations(face_image)
+        face_locations = _raw_face_rects(face_image, detection_scale=detection_scale)
     else:
         face_locations = [_css_to_rect(face_location) for face_location in face_locations]
 
-    pose_predictor = pose_predictor_68_point
-
-    if model == "small":
-        pose_predictor = pose_predictor_5_point
+    pose_predictor = _pose_predictor(model)
 
     return [pose_predictor(face_image, face_location) for face_location in face_locations]
 
@@ -198,7 +497,7 @@ def face_landmarks(face_image, face_locations=None, model="large"):
         raise ValueError("Invalid landmarks model type. Supported models are ['small', 'large'].")
 
 
-def face_encodings(face_image, known_face_locations=None, num_jitters=1, model="small"):
+def face_encodings(face_image, known_face_locations=None, num_jitters=1, model="small", detection_scale=1.0):
     """
     Given an image, return the 128-dimension face encoding for each face in the image.
 
@@ -206,12 +505,54 @@ def face_encodings(face_image, known_face_locations=None, num_jitters=1, model="
     :param known_face_locations: Optional - the bounding boxes of each face if you already know them.
     :param num_jitters: How many times to re-sample the face when calculating encoding. Higher is more accurate, but slower (i.e. 100 is 100x slower)
     :param model: Optional - which model to use. "large" (default) or "small" which only returns 5 points but is faster.
+    :param detection_scale: Optional - when face locations aren't given, detect faces on a copy of the image downscaled
+                            by this factor (eg. 0.5). Landmarks and encodings are still computed on the full image.
     :return: A list of 128-dimensional face encodings (one for each face in the image)
     """
-    raw_landmarks = _raw_face_landmarks(face_image, known_face_locations, model)
+    raw_landmarks = _raw_face_landmarks(face_image, known_face_locations, model, detection_scale)
+    face_encoder = _load_model("face_encoder")
     return [np.array(face_encoder.compute_face_descriptor(face_image, raw_landmark_set, num_jitters)) for raw_landmark_set in raw_landmarks]
 
 
+def analyze_faces(face_image, number_of_times_to_upsample=1, model="hog", landmarks_model="small", num_jitters=1, detection_scale=1.0):
+    """
+    Find the faces in an image and return the location, landmarks and 128-dimension encoding of each of them.
+
+    This is equivalent to calling `face_locations`, `face_landmarks` and `face_encodings`, but face detection and
+    landmarking run only once per image and the dlib rects are reused between steps.
+
+    :param face_image: The image that contains one or more faces
+    :param number_of_times_to_upsample: How many times to upsample the image looking for faces. Higher numbers find smaller faces.
+    :param model: Which face detection model to use. "hog" is less accurate but faster on CPUs. "cnn" is a more accurate
+                  deep-learning model which is GPU/CUDA accelerated (if available). The default is "hog".
+    :param landmarks_model: Optional - which landmarks model to use, also used to align faces for the encoding.
+                            "small" (default) which only returns 5 points but is faster, or "large" for 68 points.
+    :param num_jitters: How many times to re-sample the face when calculating encoding. Higher is more accurate, but slower (i.e. 100 is 100x slower)
+    :param detection_scale: Optional - detect faces on a copy of the image downscaled by this factor (eg. 0.5).
+                            Landmarks and encodings are still computed on the full image.
+    :return: A list of dicts, one per face, with the face "location" in css (top, right, bottom, left) order, its
+             "landmarks" as a (number of points, 2) numpy array of (x, y) coordinates and its "encoding"
+    """
+    if landmarks_model not in ("small", "large"):
+        raise ValueError("Invalid landmarks model type. Supported models are ['small', 'large'].")
+
+    rects = _raw_face_rects(face_image, number_of_times_to_upsample, model, detection_scale)
+
+    pose_predictor = _pose_predictor(landmarks_model)
+    face_encoder = _load_model("face_encoder")
+
+    faces = []
+    for rect in rects:
+        raw_landmarks = pose_predictor(face_image, rect)
+        faces.append({
+            "location": _trim_css_to_bounds(_rect_to_css(rect), face_image.shape),
+            "landmarks": np.array([(p.x, p.y) for p in raw_landmarks.parts()]),
+            "encoding": np.array(face_encoder.compute_face_descriptor(face_image, raw_landmarks, num_jitters)),
+        })
+
+    return faces
+
+
 def compare_faces(known_face_encodings, face_encoding_to_check, tolerance=0.6):
     """
     Compare a list of face encodings against a candidate encoding to see if they match.
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import api
+
+
+def image_key(image, **params):
+    """
+    Compute a cache key from the content of an image and the parameters used to process it
+
+    :param image: An image (as a numpy array)
+    :param params: the parameters which change the result (model, num_jitters, ...)
+    :return: hex digest identifying the image and parameters
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update("{}|{}|{}".format(image.shape, image.dtype, sorted(params.items())).encode('utf-8'))
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+class EncodingCache(object):
+    """
+    A cache of face encodings (and `analyze_faces` results) keyed on image content and parameters.
+
+    Results are kept in an in-process LRU of `max_entries` entries and, when a `directory` is given, in .npz files
+    there too. The directory can be shared by several processes: files are written atomically, and the least recently
+    used ones are deleted once they take more than `max_disk_bytes`.
+
+    The size of the directory is only scanned when a running total, updated with the files written by this process,
+    exceeds `max_disk_bytes`. Files written by other processes are only counted at the next scan, so a shared directory
+    can grow past the bound until then.
+    """
+
+    def __init__(self, max_entries=256, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        """
+        :param max_entries: how many results to keep in memory
+        :param directory: Optional - directory of the on-disk tier, created if missing
+        :param max_disk_bytes: how many bytes the on-disk tier can take
+        """
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Estimated size of the on-disk tier, None until it is scanned
+        self._disk_bytes = None
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, key):
+        """
+        :param key: a key computed with `image_key`
+        :return: the cached dict of numpy arrays, or None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return value
+
+        if self.directory is not None:
+            try:
+                with np.load(self._path(key), allow_pickle=False) as data:
+                    value = dict(data)
+                # Touch the file so that eviction keeps recently used entries
+                os.utime(self._path(key))
+            except (OSError, ValueError):
+                value = None
+
+            if value is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(key, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key, value):
+        """
+        :param key: a key computed with `image_key`
+        :param value: a dict of numpy arrays to cache
+        """
+        self._remember(key, value)
+
+        if self.directory is not None:
+            tmp_path = "{}.{}.{}.tmp.npz".format(self._path(key)[:-len(".npz")], os.getpid(), threading.get_ident())
+            np.savez(tmp_path, **value)
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, self._path(key))
+
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += size
+                full = self._disk_bytes is None or self._disk_bytes > self.max_disk_bytes
+            if full:
+                self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz") and ".tmp" not in entry.name:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+        with self._lock:
+            self._disk_bytes = total
+
+    def face_encodings(self, face_image, known_face_locations=None, num_jitters=1, model="small", detection_scale=1.0):
+        """
+        Same as `api.face_encodings`, returning cached encodings when the same image was already encoded with the
+        same parameters.
+        """
+        key = image_key(face_image, function="face_encodings", locations=known_face_locations, num_jitters=num_jitters, model=model,
+                        detection_scale=detection_scale)
+        value = self.get(key)
+        if value is None:
+            encodings = api.face_encodings(face_image, known_face_locations, num_jitters, model, detection_scale)
+            value = {"encodings": np.array(encodings).reshape(len(encodings), 128)}
+            self.put(key, value)
+        return list(value["encodings"])
+
+    def analyze_faces(self, face_image, number_of_times_to_upsample=1, model="hog", landmarks_model="small", num_jitters=1, detection_scale=1.0):
+        """
+        Same as `api.analyze_faces`, returning cached results when the same image was already analyzed with the
+        same parameters.
+        """
+        key = image_key(face_image, function="analyze_faces", number_of_times_to_upsample=number_of_times_to_upsample,
+                        model=model, landmarks_model=landmarks_model, num_jitters=num_jitters, detection_scale=detection_scale)
+        value = self.get(key)
+        if value is None:
+            faces = api.analyze_faces(face_image, number_of_times_to_upsample, model, landmarks_model, num_jitters, detection_scale)
+            value = {
+                "locations": np.array([face["location"] for face in faces], dtype=np.int64).reshape(len(faces), 4),
+                "landmarks": np.array([face["landmarks"] for face in faces], dtype=np.int64).reshape(len(faces), 5 if landmarks_model == "small" else 68, 2),
+                "encodings": np.array([face["encoding"] for face in faces]).reshape(len(faces), 128),
+            }
+            self.put(key, value)
+
+        return [
+            {"location": tuple(int(v) for v in location), "landmarks": landmarks, "encoding": encoding}
+            for location, landmarks, encoding in zip(value["locations"], value["landmarks"], value["encodings"])
+        ]
+
+    @property
+    def stats(self):
+        """
+        A dict with the number of 'memory_hits', 'disk_hits' and 'misses' so far
+        """
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import os
+
+# Files picked up when no include pattern is given
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png")
+
+# How many checkpoint records to buffer before flushing them to disk
+CHECKPOINT_FLUSH_EVERY = 64
+
+# How many images per worker the CLIs hand to their process pool at a time, so that huge folders aren't queued whole
+IMAGES_PER_BATCH = 256
+
+
+def _matches(name, relative_path, patterns):
+    # Patterns match either the file name or its path relative to the top folder, case-insensitively
+    name = os.path.normcase(name).lower()
+    relative_path = os.path.normcase(relative_path).lower()
+    return any(fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(relative_path, pattern) for pattern in patterns)
+
+
+def image_files(folder, recursive=False, include=None, exclude=None):
+    """
+    Generate the paths of the image files in a folder, without listing the whole folder in memory first.
+
+    Files are generated as each folder is read, in directory order, which is arbitrary. Sub-folders are scanned
+    depth-first: the paths of the sub-folders found but not scanned yet are kept in memory, so memory use grows with
+    both the depth and the width of the tree, but not with the number of files.
+
+    :param folder: folder to scan
+    :param recursive: whether to scan sub-folders too
+    :param include: Optional - glob patterns (eg. "*.jpg", "2019/*") of the files to generate. Defaults to jpg, jpeg
+                    and png files.
+    :param exclude: Optional - glob patterns of the files and sub-folders to skip
+    :return: a generator of file paths
+    """
+    include = [os.path.normcase(p).lower() for p in (include or IMAGE_PATTERNS)]
+    exclude = [os.path.normcase(p).lower() for p in (exclude or ())]
+
+    stack = [folder]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                relative_path = os.path.relpath(entry.path, folder)
+                if exclude and _matches(entry.name, relative_path, exclude):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if recursive:
+                            stack.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                if _matches(entry.name, relative_path, include):
+                    yield entry.path
+
+
+def _signature(path):
+    st = os.stat(path)
+    return "{}:{}".format(st.st_size, st.st_mtime_ns)
+
+
+class Checkpoint(object):
+    """
+    A record of the files processed so far, to resume an interrupted run and skip files which didn't change.
+
+    The record is an append-only text file of one "signature<TAB>path" line per processed file, where the signature
+    is the size and modification time of the file when it was processed. Lines are only appended once a file is
+    completely processed, and written by groups of `CHECKPOINT_FLUSH_EVERY`: a run stopped at any point resumes with
+    the files it didn't finish, and at most that many files it did.
+
+    The whole record is kept in memory, at roughly 150 bytes plus the length of the path per processed file (about
+    200 MB for a million files).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file of the record, created if missing
+        """
+        self.path = path
+        self.skipped = 0
+        self._done = {}
+        self._pending = {}
+        self._buffer = []
+
+        lines = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    signature, sep, file = line.rstrip("\n").partition("\t")
+                    # Ignore a last line cut short by a crash
+                    if sep and line.endswith("\n"):
+                        self._done[file] = signature
+                        lines += 1
+
+        # Files processed several times have several lines: drop the stale ones
+        if lines > 2 * len(self._done) + 1000:
+            self._rewrite()
+
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _rewrite(self):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for file, signature in self._done.items():
+                f.write("{}\t{}\n".format(signature, file))
+        os.replace(tmp_path, self.path)
+
+    def pending(self, paths):
+        """
+        Filter out the files which were already processed and didn't change since
+
+        :param paths: iterable of file paths
+        :return: a generator of the paths left to process. Pass each one to `done` once processed.
+        """
+        for path in paths:
+            try:
+                signature = _signature(path)
+            except OSError:
+                continue
+            if self._done.get(path) == signature:
+                self.skipped += 1
+                continue
+            self._pending[path] = signature
+            yield path
+
+    def done(self, path):
+        """
+        Record a file generated by `pending` as processed
+
+        :param path: path of the file
+        """
+        signature = self._pending.pop(path)
+        self._done[path] = signature
+        self._buffer.append("{}\t{}\n".format(signature, path))
+        if len(self._buffer) >= CHECKPOINT_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self):
+        self._file.write("".join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def batches(iterable, size):
+    """
+    Split an iterable in lists of at most `size` items, to hand a generator to a process pool a bit at a time
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
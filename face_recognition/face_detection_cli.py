@@ -2,11 +2,11 @@
 from __future__ import print_function
 import click
 import os
-import re
 import face_recognition.api as face_recognition
+from face_recognition.crawl import image_files, batches, Checkpoint, IMAGES_PER_BATCH
 import multiprocessing
 import sys
-import itertools
+import functools
 
 
 def print_result(filename, location):
@@ -15,20 +15,22 @@ def print_result(filename, location):
 
 
 def test_image(image_to_check, model):
-    unknown_image = face_recognition.load_image_file(image_to_check)
-    face_locations = face_recognition.face_locations(unknown_image, number_of_times_to_upsample=0, model=model)
-
-    for face_location in face_locations:
+    for face_location in detect_image(image_to_check, model):
         print_result(image_to_check, face_location)
 
 
-def image_files_in_folder(folder):
-    return [os.path.join(folder, f) for f in os.listdir(folder) if re.match(r'.*\.(jpg|jpeg|png)', f, flags=re.I)]
+def detect_image(image_to_check, model):
+    unknown_image = face_recognition.load_image_file(image_to_check)
+    return face_recognition.face_locations(unknown_image, number_of_times_to_upsample=0, model=model)
+
 
+def _detect_image_in_worker(image_to_check, model):
+    return image_to_check, detect_image(image_to_check, model)
 
-def process_images_in_process_pool(images_to_check, number_of_cpus, model):
+
+def process_images_in_process_pool(images_to_check, number_of_cpus, model, checkpoint=None):
     if number_of_cpus == -1:
-        processes = None
+        processes = multiprocessing.cpu_count()
     else:
         processes = number_of_cpus
 
@@ -38,30 +40,56 @@ def process_images_in_process_pool(images_to_check, number_of_cpus, model):
         context = multiprocessing.get_context("forkserver")
 
     pool = context.Pool(processes=processes)
-
-    function_parameters = zip(
-        images_to_check,
-        itertools.repeat(model),
-    )
-
-    pool.starmap(test_image, function_parameters)
+    try:
+        for batch in batches(images_to_check, IMAGES_PER_BATCH * processes):
+            chunksize = max(1, min(16, len(batch) // (4 * processes)))
+            # Print from the parent, in the order the images are done, so that the checkpoint only records printed images
+            for image_to_check, face_locations in pool.imap_unordered(functools.partial(_detect_image_in_worker, model=model), batch, chunksize):
+                for face_location in face_locations:
+                    print_result(image_to_check, face_location)
+                if checkpoint is not None:
+                    checkpoint.done(image_to_check)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
 @click.command()
 @click.argument('image_to_check')
 @click.option('--cpus', default=1, help='number of CPU cores to use in parallel. -1 means "use all in system"')
 @click.option('--model', default="hog", help='Which face detection model to use. Options are "hog" or "cnn".')
-def main(image_to_check, cpus, model):
+@click.option('--recursive', is_flag=True, help='Also check the images in the sub-folders of image_to_check.')
+@click.option('--include', multiple=True, help='Only check the images matching this glob pattern (file name or path relative to image_to_check). Can be repeated. Default is jpg, jpeg and png files.')
+@click.option('--exclude', multiple=True, help='Skip the images and sub-folders matching this glob pattern. Can be repeated.')
+@click.option('--checkpoint', default=None, help='File recording the images checked so far. Re-runs skip the images which did not change since, so an interrupted run resumes where it stopped.')
+def main(image_to_check, cpus, model, recursive, include, exclude, checkpoint):
     # Multi-core processing only supported on Python 3.4 or greater
     if (sys.version_info < (3, 4)) and cpus != 1:
         click.echo("WARNING: Multi-processing support requires Python 3.4 or greater. Falling back to single-threaded processing!")
         cpus = 1
 
     if os.path.isdir(image_to_check):
-        if cpus == 1:
-            [test_image(image_file, model) for image_file in image_files_in_folder(image_to_check)]
-        else:
-            process_images_in_process_pool(image_files_in_folder(image_to_check), cpus, model)
+        checkpoint = Checkpoint(checkpoint) if checkpoint is not None else None
+        images_to_check = image_files(image_to_check, recursive, include, exclude)
+        if checkpoint is not None:
+            images_to_check = checkpoint.pending(images_to_check)
+
+        try:
+            if cpus == 1:
+                for image_file in images_to_check:
+                    test_image(image_file, model)
+                    if checkpoint is not None:
+                        checkpoint.done(image_file)
+            else:
+                process_images_in_process_pool(images_to_check, cpus, model, checkpoint)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+                if checkpoint.skipped:
+                    click.echo("Skipped {} unchanged images already in {}".format(checkpoint.skipped, checkpoint.path), err=True)
     else:
         test_image(image_to_check, model)
 
@@ -2,20 +2,33 @@
 from __future__ import print_function
 import click
 import os
-import re
 import face_recognition.api as face_recognition
+from face_recognition.gallery import open_gallery
+from face_recognition.ann import IVFIndex, load_or_build_index
+from face_recognition.crawl import image_files, batches, Checkpoint, IMAGES_PER_BATCH
 import multiprocessing
 import itertools
+import shutil
 import sys
-import PIL.Image
+import tempfile
 import numpy as np
 
+# How many nearest known faces to report per unknown face when matching with an index
+INDEX_MAX_MATCHES = 10
+
+# Larger images to check are scaled down to this size (in pixels, on their largest side) while being decoded
+MAX_IMAGE_SIZE = 1600
+
+
+def scan_known_people(known_people_folder, gallery_path=None):
+    if gallery_path is not None:
+        gallery = open_gallery(gallery_path, known_people_folder, on_warning=click.echo)
+        return gallery.names, gallery.encodings
 
-def scan_known_people(known_people_folder):
     known_names = []
     known_face_encodings = []
 
-    for file in image_files_in_folder(known_people_folder):
+    for file in image_files(known_people_folder):
         basename = os.path.splitext(os.path.basename(file))[0]
         img = face_recognition.load_image_file(file)
         encodings = face_recognition.face_encodings(img)
@@ -39,38 +52,66 @@ def print_result(filename, name, distance, show_distance=False):
         print("{},{}".format(filename, name))
 
 
-def test_image(image_to_check, known_names, known_face_encodings, tolerance=0.6, show_distance=False):
-    unknown_image = face_recognition.load_image_file(image_to_check)
+def test_image(image_to_check, known_names, known_face_encodings, tolerance=0.6, show_distance=False, index=None, nprobe=8):
+    for result in match_image(image_to_check, known_names, known_face_encodings, tolerance, index, nprobe):
+        print_result(*result, show_distance=show_distance)
+
 
+def match_image(image_to_check, known_names, known_face_encodings, tolerance=0.6, index=None, nprobe=8):
+    """
+    Match the faces of an image against the known faces
+
+    :return: a list of (filename, name, distance) results to print
+    """
+    results = []
     # Scale down image if it's giant so things run a little faster
-    if max(unknown_image.shape) > 1600:
-        pil_img = PIL.Image.fromarray(unknown_image)
-        pil_img.thumbnail((1600, 1600), PIL.Image.LANCZOS)
-        unknown_image = np.array(pil_img)
+    unknown_image = face_recognition.load_image_file(image_to_check, max_size=MAX_IMAGE_SIZE)
 
     unknown_encodings = face_recognition.face_encodings(unknown_image)
 
-    for unknown_encoding in unknown_encodings:
-        distances = face_recognition.face_distance(known_face_encodings, unknown_encoding)
+    if index is not None:
+        match_indices, distance_matrix = index.search(unknown_encodings, k=INDEX_MAX_MATCHES, nprobe=nprobe)
+        candidate_names = [[known_names[i] if i >= 0 else None for i in indices] for indices in match_indices]
+    else:
+        distance_matrix = face_recognition.face_distance_matrix(unknown_encodings, known_face_encodings)
+        candidate_names = itertools.repeat(known_names)
+
+    for distances, names in zip(distance_matrix, candidate_names):
         result = list(distances <= tolerance)
 
         if True in result:
-            [print_result(image_to_check, name, distance, show_distance) for is_match, name, distance in zip(result, known_names, distances) if is_match]
+            results.extend((image_to_check, name, distance) for is_match, name, distance in zip(result, names, distances) if is_match)
         else:
-            print_result(image_to_check, "unknown_person", None, show_distance)
+            results.append((image_to_check, "unknown_person", None))
 
     if not unknown_encodings:
         # print out fact that no faces were found in image
-        print_result(image_to_check, "no_persons_found", None, show_distance)
+        results.append((image_to_check, "no_persons_found", None))
+
+    return results
 
 
-def image_files_in_folder(folder):
-    return [os.path.join(folder, f) for f in os.listdir(folder) if re.match(r'.*\.(jpg|jpeg|png)', f, flags=re.I)]
+# Known faces and matching options of a process pool worker, set once by _init_worker
+_worker_state = None
 
 
-def process_images_in_process_pool(images_to_check, known_names, known_face_encodings, number_of_cpus, tolerance, show_distance):
+def _init_worker(known_names, encodings_path, tolerance, index_path, nprobe):
+    global _worker_state
+    # Memory-mapped: the pages of the encodings (and index) are shared by all the workers
+    known_face_encodings = np.load(encodings_path, mmap_mode='r')
+    index = IVFIndex.load_arrays(index_path, mmap_mode='r') if index_path is not None else None
+    _worker_state = (known_names, known_face_encodings, tolerance, index, nprobe)
+
+
+def _match_image_in_worker(image_to_check):
+    known_names, known_face_encodings, tolerance, index, nprobe = _worker_state
+    return image_to_check, match_image(image_to_check, known_names, known_face_encodings, tolerance, index, nprobe)
+
+
+def process_images_in_process_pool(images_to_check, known_names, known_face_encodings, number_of_cpus, tolerance, show_distance, index=None, nprobe=8,
+                                   checkpoint=None):
     if number_of_cpus == -1:
-        processes = None
+        processes = multiprocessing.cpu_count()
     else:
         processes = number_of_cpus
 
@@ -79,17 +120,35 @@ def process_images_in_process_pool(images_to_check, known_names, known_face_enco
     if "forkserver" in multiprocessing.get_all_start_methods():
         context = multiprocessing.get_context("forkserver")
 
-    pool = context.Pool(processes=processes)
-
-    function_parameters = zip(
-        images_to_check,
-        itertools.repeat(known_names),
-        itertools.repeat(known_face_encodings),
-        itertools.repeat(tolerance),
-        itertools.repeat(show_distance)
-    )
-
-    pool.starmap(test_image, function_parameters)
+    # Publish the known encodings and the index once, in files the workers memory-map, instead of pickling them with
+    # every image or worker
+    directory = tempfile.mkdtemp(prefix="face_recognition-")
+    try:
+        encodings_path = os.path.join(directory, "known_encodings.npy")
+        np.save(encodings_path, np.asarray(known_face_encodings, dtype=np.float64).reshape(len(known_face_encodings), 128))
+        index_path = None
+        if index is not None:
+            index_path = os.path.join(directory, "index")
+            index.save_arrays(index_path)
+
+        pool = context.Pool(processes=processes, initializer=_init_worker,
+                            initargs=(known_names, encodings_path, tolerance, index_path, nprobe))
+        try:
+            for batch in batches(images_to_check, IMAGES_PER_BATCH * processes):
+                chunksize = max(1, min(16, len(batch) // (4 * processes)))
+                for image_to_check, results in pool.imap_unordered(_match_image_in_worker, batch, chunksize):
+                    for result in results:
+                        print_result(*result, show_distance=show_distance)
+                    if checkpoint is not None:
+                        checkpoint.done(image_to_check)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
 
 @click.command()
@@ -98,8 +157,20 @@ def process_images_in_process_pool(images_to_check, known_names, known_face_enco
 @click.option('--cpus', default=1, help='number of CPU cores to use in parallel (can speed up processing lots of images). -1 means "use all in system"')
 @click.option('--tolerance', default=0.6, help='Tolerance for face comparisons. Default is 0.6. Lower this if you get multiple matches for the same person.')
 @click.option('--show-distance', default=False, type=bool, help='Output face distance. Useful for tweaking tolerance setting.')
-def main(known_people_folder, image_to_check, cpus, tolerance, show_distance):
-    known_names, known_face_encodings = scan_known_people(known_people_folder)
+@click.option('--gallery', default=None, help='Directory of a persistent gallery of known faces. Only new or changed images in known_people_folder are encoded again.')
+@click.option('--index', default=None, help='File of an approximate nearest neighbour index of the known faces, built if missing or outdated. Faster with very large galleries, but may miss matches.')
+@click.option('--nprobe', default=8, help='How many index lists to scan per face when using --index. Higher is more accurate, but slower.')
+@click.option('--recursive', is_flag=True, help='Also check the images in the sub-folders of image_to_check.')
+@click.option('--include', multiple=True, help='Only check the images matching this glob pattern (file name or path relative to image_to_check). Can be repeated. Default is jpg, jpeg and png files.')
+@click.option('--exclude', multiple=True, help='Skip the images and sub-folders matching this glob pattern. Can be repeated.')
+@click.option('--checkpoint', default=None, help='File recording the images checked so far. Re-runs skip the images which did not change since, so an interrupted run resumes where it stopped.')
+def main(known_people_folder, image_to_check, cpus, tolerance, show_distance, gallery, index, nprobe, recursive, include, exclude, checkpoint):
+    known_names, known_face_encodings = scan_known_people(known_people_folder, gallery)
+
+    if index is not None and len(known_face_encodings) > 0:
+        index = load_or_build_index(index, known_face_encodings)
+    else:
+        index = None
 
     # Multi-core processing only supported on Python 3.4 or greater
     if (sys.version_info < (3, 4)) and cpus != 1:
@@ -107,12 +178,27 @@ def main(known_people_folder, image_to_check, cpus, tolerance, show_distance):
         cpus = 1
 
     if os.path.isdir(image_to_check):
-        if cpus == 1:
-            [test_image(image_file, known_names, known_face_encodings, tolerance, show_distance) for image_file in image_files_in_folder(image_to_check)]
-        else:
-            process_images_in_process_pool(image_files_in_folder(image_to_check), known_names, known_face_encodings, cpus, tolerance, show_distance)
+        checkpoint = Checkpoint(checkpoint) if checkpoint is not None else None
+        images_to_check = image_files(image_to_check, recursive, include, exclude)
+        if checkpoint is not None:
+            images_to_check = checkpoint.pending(images_to_check)
+
+        try:
+            if cpus == 1:
+                for image_file in images_to_check:
+                    test_image(image_file, known_names, known_face_encodings, tolerance, show_distance, index, nprobe)
+                    if checkpoint is not None:
+                        checkpoint.done(image_file)
+            else:
+                process_images_in_process_pool(images_to_check, known_names, known_face_encodings, cpus, tolerance, show_distance, index, nprobe,
+                                               checkpoint)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+                if checkpoint.skipped:
+                    click.echo("Skipped {} unchanged images already in {}".format(checkpoint.skipped, checkpoint.path), err=True)
     else:
-        test_image(image_to_check, known_names, known_face_encodings, tolerance, show_distance)
+        test_image(image_to_check, known_names, known_face_encodings, tolerance, show_distance, index, nprobe)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # No inter-process locking on Windows
+    fcntl = None
+
+from . import api
+from .crawl import image_files
+
+ENCODINGS_FILE = "encodings.npy"
+INDEX_FILE = "index.json"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "lock"
+GENERATION_PREFIX = "gen-"
+GALLERY_VERSION = 1
+
+
+def _file_sha1(path, chunk_size=1 << 20):
+    """
+    Hash the contents of a file without reading it into memory at once
+
+    :param path: path of the file to hash
+    :param chunk_size: how many bytes to read per iteration
+    :return: hex digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on a gallery store, shared by every process using it
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, LOCK_FILE), 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class FaceGallery(object):
+    """
+    A persistent store of known face encodings which is updated incrementally.
+
+    Each version of the store (a generation) is a directory holding two files:
+
+    - encodings.npy: a (N, 128) matrix with one row per known face, memory-mapped on load
+    - index.json: the encoding parameters plus one entry per source image (name, sha1, mtime, size, row)
+
+    A new generation is written next to the current one, then the CURRENT file naming the current generation is
+    replaced, so that readers always see a matching pair of files. Updates are serialized between processes with a
+    lock file.
+
+    Only images which were added or whose content changed since the last `sync` are decoded and
+    encoded again. Images that disappeared are dropped from the store.
+    """
+
+    def __init__(self, path, num_jitters=1, model="small"):
+        """
+        :param path: directory of the store. It is created on the first `save`.
+        :param num_jitters: num_jitters used with `face_encodings` for new images
+        :param model: landmarks model used with `face_encodings` for new images
+        """
+        self.path = path
+        self.num_jitters = num_jitters
+        self.model = model
+        self.generation = None
+        self._entries = {}
+        self._encodings = np.empty((0, 128))
+        self._load()
+
+    @property
+    def encodings(self):
+        """
+        The (N, 128) matrix of known face encodings, in the same order as `names`
+        """
+        return self._encodings
+
+    @property
+    def names(self):
+        """
+        The list of known face names, in the same order as `encodings`
+        """
+        names = [None] * len(self._encodings)
+        for entry in self._entries.values():
+            if entry["row"] is not None:
+                names[entry["row"]] = entry["name"]
+        return names
+
+    def __len__(self):
+        return len(self._encodings)
+
+    def _current(self):
+        try:
+            with open(os.path.join(self.path, CURRENT_FILE)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        # A concurrent save may delete the generation between reading CURRENT and opening its files: read it again
+        for _ in range(3):
+            generation = self._current()
+            if generation is None:
+                return
+            try:
+                with open(os.path.join(self.path, generation, INDEX_FILE)) as f:
+                    index = json.load(f)
+                encodings = np.load(os.path.join(self.path, generation, ENCODINGS_FILE), mmap_mode='r')
+                break
+            except FileNotFoundError:
+                continue
+        else:
+            return
+
+        self.generation = generation
+        # Encodings computed with other parameters can't be mixed with new ones: start from scratch
+        if index.get("version") != GALLERY_VERSION or index.get("model") != self.model or index.get("num_jitters") != self.num_jitters:
+            self._entries = {}
+            self._encodings = np.empty((0, 128))
+            return
+
+        self._entries = index["entries"]
+        self._encodings = encodings
+
+    def refresh(self):
+        """
+        Reload the store if another process saved a newer version of it since it was loaded
+
+        :return: True when the store was reloaded
+        """
+        if self._current() == self.generation:
+            return False
+        self._load()
+        return True
+
+    def save(self, encodings=None):
+        """
+        Atomically write the store to disk and re-open the encodings memory-mapped
+
+        :param encodings: Optional - the new encodings matrix. Defaults to the current one.
+        """
+        with _locked(self.path):
+            self._save(encodings)
+
+    def _save(self, encodings=None):
+        if encodings is None:
+            encodings = self._encodings
+
+        generation = GENERATION_PREFIX + uuid.uuid4().hex
+        directory = os.path.join(self.path, generation)
+        os.makedirs(directory)
+        np.save(os.path.join(directory, ENCODINGS_FILE), np.asarray(encodings, dtype=np.float64).reshape(-1, 128))
+        with open(os.path.join(directory, INDEX_FILE), 'w') as f:
+            json.dump({
+                "version": GALLERY_VERSION,
+                "model": self.model,
+                "num_jitters": self.num_jitters,
+                "entries": self._entries,
+            }, f)
+
+        current_path = os.path.join(self.path, CURRENT_FILE)
+        tmp_current_path = "{}.{}.tmp".format(current_path, os.getpid())
+        with open(tmp_current_path, 'w') as f:
+            f.write(generation)
+        previous = self._current()
+        os.replace(tmp_current_path, current_path)
+
+        # Keep the previous generation for readers which just read CURRENT, and drop older (or unfinished) ones
+        for name in os.listdir(self.path):
+            if name.startswith(GENERATION_PREFIX) and name not in (generation, previous):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+        self.generation = generation
+        self._encodings = np.load(os.path.join(directory, ENCODINGS_FILE), mmap_mode='r')
+
+    def sync_folder(self, folder, on_warning=None):
+        """
+        Bring the store up to date with the images found in a folder
+
+        :param folder: folder containing one image per known person, named after the person
+        :param on_warning: Optional - callable receiving a message for each image which is skipped or ambiguous
+        :return: a dict counting the 'added', 'updated', 'removed' and 'unchanged' images
+        """
+        return self.sync(image_files(folder), on_warning)
+
+    def sync(self, files, on_warning=None):
+        """
+        Bring the store up to date with a list of images. Images which are in the store but not in
+        `files` are removed from it.
+
+        :param files: paths of the images of known people, each named after the person
+        :param on_warning: Optional - callable receiving a message for each image which is skipped or ambiguous
+        :return: a dict counting the 'added', 'updated', 'removed' and 'unchanged' images
+        """
+        # One process updates the store at a time, starting from the latest version saved by the others
+        with _locked(self.path):
+            self.refresh()
+            return self._sync(files, on_warning)
+
+    def _sync(self, files, on_warning):
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0}
+        entries = {}
+        kept_rows = []
+        new_encodings = []
+        dirty = False
+
+        for file in files:
+            key = os.path.abspath(file)
+            st = os.stat(key)
+            old = self._entries.get(key)
+
+            if old is not None and old["mtime"] == st.st_mtime and old["size"] == st.st_size:
+                sha1 = old["sha1"]
+            else:
+                sha1 = _file_sha1(key)
+                dirty = True
+
+            if old is not None and old["sha1"] == sha1:
+                entry = dict(old, mtime=st.st_mtime, size=st.st_size)
+                if old["row"] is not None:
+                    entry["row"] = len(kept_rows)
+                    kept_rows.append(old["row"])
+                entries[key] = entry
+                stats["unchanged"] += 1
+                continue
+
+            stats["updated" if old is not None else "added"] += 1
+            entry = {
+                "name": os.path.splitext(os.path.basename(file))[0],
+                "sha1": sha1,
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "row": None,
+            }
+            entries[key] = entry
+
+            img = api.load_image_file(key)
+            encodings = api.face_encodings(img, num_jitters=self.num_jitters, model=self.model)
+
+            if len(encodings) > 1 and on_warning:
+                on_warning("WARNING: More than one face found in {}. Only considering the first face.".format(file))
+
+            if len(encodings) == 0:
+                if on_warning:
+                    on_warning("WARNING: No faces found in {}. Ignoring file.".format(file))
+            else:
+                entry["row"] = -1 - len(new_encodings)
+                new_encodings.append(encodings[0])
+
+        stats["removed"] = len(set(self._entries) - set(entries))
+        if not (dirty or stats["added"] or stats["updated"] or stats["removed"]):
+            return stats
+
+        # New rows go after the kept ones; they were tagged with negative placeholders above
+        for entry in entries.values():
+            if entry["row"] is not None and entry["row"] < 0:
+                entry["row"] = len(kept_rows) + (-1 - entry["row"])
+
+        encodings = np.empty((len(kept_rows) + len(new_encodings), 128))
+        if kept_rows:
+            encodings[:len(kept_rows)] = self._encodings[kept_rows]
+        if new_encodings:
+            encodings[len(kept_rows):] = new_encodings
+
+        self._entries = entries
+        self._save(encodings)
+        return stats
+
+
+def open_gallery(path, known_people_folder=None, num_jitters=1, model="small", on_warning=None):
+    """
+    Open a persistent gallery of known faces, optionally syncing it with a folder of images first
+
+    :param path: directory of the gallery store
+    :param known_people_folder: Optional - folder with one image per known person to sync the store with
+    :param num_jitters: num_jitters used with `face_encodings` for new images
+    :param model: landmarks model used with `face_encodings` for new images
+    :param on_warning: Optional - callable receiving a message for each image which is skipped or ambiguous
+    :return: a FaceGallery
+    """
+    gallery = FaceGallery(path, num_jitters=num_jitters, model=model)
+    if known_people_folder is not None:
+        gallery.sync_folder(known_people_folder, on_warning)
+    return gallery
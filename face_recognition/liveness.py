@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+# Indices of the eyes in the 68 point landmarks (same naming as api.face_landmarks)
+LEFT_EYE = slice(36, 42)
+RIGHT_EYE = slice(42, 48)
+
+
+def landmarks_to_array(shape):
+    """
+    Convert a dlib 'full_object_detection' (eg. the result of a shape predictor) to a numpy array
+
+    :param shape: a dlib 'full_object_detection' object
+    :return: a (number of points, 2) numpy array of (x, y) coordinates
+    """
+    return np.array([(p.x, p.y) for p in shape.parts()], dtype=np.float64)
+
+
+def eye_aspect_ratio(eyes):
+    """
+    Compute the eye aspect ratio (EAR) of one or many eyes: the mean height of the eye over its width. It drops
+    towards 0 when the eye closes.
+
+    :param eyes: a (..., 6, 2) numpy array of eye landmarks, in the order of the 68 point model
+    :return: a numpy array (or a float for a single eye) of eye aspect ratios with shape (...)
+    """
+    eyes = np.asarray(eyes, dtype=np.float64)
+    vertical = np.linalg.norm(eyes[..., [1, 2], :] - eyes[..., [5, 4], :], axis=-1).sum(axis=-1)
+    horizontal = np.linalg.norm(eyes[..., 0, :] - eyes[..., 3, :], axis=-1)
+    return vertical / (2.0 * horizontal)
+
+
+def eyes_aspect_ratio(landmarks):
+    """
+    Compute the mean eye aspect ratio of both eyes, for any number of faces (and frames) at once
+
+    :param landmarks: a (..., 68, 2) numpy array of 68 point landmarks, eg. all the faces of a frame stacked
+    :return: a numpy array of eye aspect ratios with shape (...), or with shape (0,) for an empty list of faces
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float64)
+    if landmarks.size == 0:
+        # An empty list of faces has no landmark dimensions at all
+        return np.empty(landmarks.shape[:-2] if landmarks.ndim >= 3 else (0,))
+    return (eye_aspect_ratio(landmarks[..., LEFT_EYE, :]) + eye_aspect_ratio(landmarks[..., RIGHT_EYE, :])) / 2.0
+
+
+class BlinkDetector(object):
+    """
+    Streaming blink detection for one face: feed it the eye aspect ratio of each frame.
+
+    Eyes are closed while the ratio is under `threshold`. A blink is counted when the eyes open again after having
+    been closed for at least `consec_frames` frames.
+    """
+
+    def __init__(self, threshold=0.20, consec_frames=1):
+        """
+        :param threshold: eye aspect ratio under which the eyes are considered closed
+        :param consec_frames: minimum number of frames the eyes must stay closed for a blink to count
+        """
+        self.threshold = threshold
+        self.consec_frames = consec_frames
+        self.counter = 0
+        self.total = 0
+
+    def update(self, ear):
+        """
+        Update the blink state with the eye aspect ratio of the next frame
+
+        :param ear: the eye aspect ratio of the face in the next frame
+        :return: True if the eyes are closed in this frame
+        """
+        if ear < self.threshold:
+            self.counter += 1
+            return True
+
+        if self.counter >= self.consec_frames:
+            self.total += 1
+        self.counter = 0
+        return False
+
+
+def count_blinks(ears, threshold=0.20, consec_frames=1):
+    """
+    Count the blinks in a whole series of eye aspect ratios of one face at once. Gives the same result as feeding the
+    series to a BlinkDetector, except that eyes still closed at the end of the series don't count as a blink.
+
+    :param ears: a 1d sequence of eye aspect ratios, one per frame
+    :param threshold: eye aspect ratio under which the eyes are considered closed
+    :param consec_frames: minimum number of frames the eyes must stay closed for a blink to count
+    :return: the number of blinks
+    """
+    closed = np.concatenate([[False], np.asarray(ears) < threshold, [False]])
+    edges = np.diff(closed.astype(np.int8))
+    starts = np.nonzero(edges == 1)[0]
+    ends = np.nonzero(edges == -1)[0]
+    # The last run only ends with the padding: its eyes never opened again
+    complete = ends < len(closed) - 2
+    return int(((ends - starts)[complete] >= consec_frames).sum())
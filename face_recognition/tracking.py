@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+
+import numpy as np
+
+from . import api
+
+
+def _iou(a, b):
+    """
+    Intersection over union of two rects in css (top, right, bottom, left) order
+    """
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - intersection
+    return intersection / float(union) if union > 0 else 0.0
+
+
+class Track(object):
+    """
+    A face followed across the frames of a video.
+
+    `data` is free for callers to keep per-face state in (eg. blink counters).
+    """
+
+    def __init__(self, track_id, location):
+        self.id = track_id
+        self.location = location
+        self.hits = 1
+        self.misses = 0
+        self.data = {}
+
+    @property
+    def rect(self):
+        """
+        The last location of the face as a dlib 'rect' object
+        """
+        return api._css_to_rect(self.location)
+
+
+class FaceTracker(object):
+    """
+    Follow faces across the frames of a video while running as little face detection as possible.
+
+    Between full-frame detections, each track is looked for only in a region around its last location (expanded by
+    `roi_margin` times the face size on each side). A full-frame detection runs every `full_detection_interval` frames,
+    or on the next frame after a track was lost, and its results are matched to the tracks by overlap (IoU). Faces
+    which are not matched start new tracks, and tracks missed more than `max_misses` times in a row are dropped.
+    """
+
+    def __init__(self, detect, full_detection_interval=10, roi_margin=0.5, max_misses=2, min_iou=0.3):
+        """
+        :param detect: callable returning a list of dlib 'rect' objects of the faces in an image (eg. `lambda img: detector(img, 0)`)
+        :param full_detection_interval: run a full-frame detection at least every that many frames. None to only run
+                                        one when a track is lost, eg. when the caller already passes the detections.
+        :param roi_margin: how much to expand the region searched around a track, relative to the face size
+        :param max_misses: how many frames in a row a track can be missed before it is dropped
+        :param min_iou: minimum overlap between a detection and a track to consider they are the same face
+        """
+        self.detect = detect
+        self.full_detection_interval = full_detection_interval
+        self.roi_margin = roi_margin
+        self.max_misses = max_misses
+        self.min_iou = min_iou
+        self.tracks = []
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.tracks_started = 0
+        self._ids = itertools.count()
+        self._frames_since_full_detection = 0
+        # Nothing is tracked yet: the first frame needs a full-frame detection
+        self._track_lost = True
+
+    def update(self, image, detections=None):
+        """
+        Follow the faces in the next frame
+
+        :param image: the next frame (as a numpy array)
+        :param detections: Optional - dlib 'rect' objects from a full-frame detection already run on this frame (eg. by
+                           a FramePipeline worker). When None, the tracker decides which detection to run itself.
+        :return: the list of Tracks found in this frame
+        """
+        self._frames_since_full_detection += 1
+
+        if detections is None and (self._track_lost or (self.full_detection_interval is not None and
+                                                        self._frames_since_full_detection >= self.full_detection_interval)):
+            detections = self.detect(image)
+
+        if detections is not None:
+            self.full_detections += 1
+            self._frames_since_full_detection = 0
+            self._track_lost = False
+            self._match([api._trim_css_to_bounds(api._rect_to_css(rect), image.shape) for rect in detections])
+        else:
+            self._follow(image)
+
+        return [track for track in self.tracks if track.misses == 0]
+
+    def _miss(self, track):
+        track.misses += 1
+        if track.misses > self.max_misses:
+            self.tracks.remove(track)
+            self._track_lost = True
+
+    def _match(self, locations):
+        pairs = sorted(
+            ((_iou(track.location, location), t, d) for t, track in enumerate(self.tracks) for d, location in enumerate(locations)),
+            reverse=True
+        )
+        matched_tracks = set()
+        matched_locations = set()
+        for iou, t, d in pairs:
+            if iou < self.min_iou:
+                break
+            if t in matched_tracks or d in matched_locations:
+                continue
+            matched_tracks.add(t)
+            matched_locations.add(d)
+            self._hit(self.tracks[t], locations[d])
+
+        for track in [track for t, track in enumerate(self.tracks) if t not in matched_tracks]:
+            self._miss(track)
+
+        for d, location in enumerate(locations):
+            if d not in matched_locations:
+                self.tracks.append(Track(next(self._ids), location))
+                self.tracks_started += 1
+
+    def _hit(self, track, location):
+        track.location = location
+        track.hits += 1
+        track.misses = 0
+
+    def _follow(self, image):
+        height, width = image.shape[:2]
+        for track in list(self.tracks):
+            top, right, bottom, left = track.location
+            margin_y = int((bottom - top) * self.roi_margin)
+            margin_x = int((right - left) * self.roi_margin)
+            roi_top, roi_left = max(0, top - margin_y), max(0, left - margin_x)
+            roi_bottom, roi_right = min(height, bottom + margin_y), min(width, right + margin_x)
+
+            self.roi_detections += 1
+            roi = np.ascontiguousarray(image[roi_top:roi_bottom, roi_left:roi_right])
+            candidates = [
+                (rect.top() + roi_top, rect.right() + roi_left, rect.bottom() + roi_top, rect.left() + roi_left)
+                for rect in self.detect(roi)
+            ] if roi.size else []
+
+            best = max(candidates, key=lambda location: _iou(track.location, location), default=None)
+            if best is not None and _iou(track.location, best) >= self.min_iou:
+                self._hit(track, api._trim_css_to_bounds(best, image.shape))
+            else:
+                self._miss(track)
+
+    @property
+    def stats(self):
+        """
+        A dict with the number of 'full_detections', region of interest detections ('roi_detections') and
+        'tracks_started' so far
+        """
+        return {"full_detections": self.full_detections, "roi_detections": self.roi_detections, "tracks_started": self.tracks_started}
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+_END = object()
+
+
+class MotionGate(object):
+    """
+    Cheap change detection between video frames, used to skip face detection when nothing moved.
+
+    Each frame is compared to the last frame which was fully processed, on a copy subsampled to about `sample_width`
+    pixels wide. Detection is needed when the mean absolute pixel difference exceeds `threshold` (in 0-255 intensity
+    units), or after `max_skip` consecutive skipped frames so that slow changes are eventually picked up.
+    """
+
+    def __init__(self, threshold=2.0, max_skip=10, sample_width=64):
+        """
+        :param threshold: mean absolute difference (0-255) above which a frame is considered to have changed
+        :param max_skip: maximum number of consecutive frames which can be skipped
+        :param sample_width: approximate width of the subsampled frames which are compared
+        """
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.sample_width = sample_width
+        self.detected = 0
+        self.skipped = 0
+        self._reference = None
+        self._skipped_in_a_row = 0
+
+    def _sample(self, frame):
+        step = max(1, frame.shape[1] // self.sample_width)
+        return frame[::step, ::step].astype(np.int16)
+
+    def needs_detection(self, frame):
+        """
+        Tell whether a frame changed enough since the last detected frame to run detection again
+
+        :param frame: the next frame of the video (as a numpy array)
+        :return: True if detection must run on this frame
+        """
+        sample = self._sample(frame)
+        if (self._reference is None or self._reference.shape != sample.shape or self._skipped_in_a_row >= self.max_skip
+                or np.abs(sample - self._reference).mean() > self.threshold):
+            self._reference = sample
+            self._skipped_in_a_row = 0
+            self.detected += 1
+            return True
+
+        self._skipped_in_a_row += 1
+        self.skipped += 1
+        return False
+
+    @property
+    def stats(self):
+        """
+        A dict with the number of 'detected' and 'skipped' frames so far
+        """
+        return {"detected": self.detected, "skipped": self.skipped}
+
+
+class IntervalGate(object):
+    """
+    Gate for FramePipeline which requests full processing of one frame out of `interval`
+    """
+
+    def __init__(self, interval):
+        self.interval = max(1, interval)
+        self.frames = 0
+
+    def needs_detection(self, frame):
+        needed = self.frames % self.interval == 0
+        self.frames += 1
+        return needed
+
+
+class GateChain(object):
+    """
+    Gate for FramePipeline combining several gates: a frame is fully processed only if every gate requests it.
+
+    Gates are asked in order and each one only sees the frames all the previous ones requested, eg.
+    `GateChain(IntervalGate(10), MotionGate())` runs the motion check only on one frame out of 10.
+    """
+
+    def __init__(self, *gates):
+        self.gates = gates
+
+    def needs_detection(self, frame):
+        return all(gate.needs_detection(frame) for gate in self.gates)
+
+
+class FramePipeline(object):
+    """
+    Process the frames of a video on several threads while keeping their order.
+
+    A decoder thread calls `read_frame` and hands each frame to a pool of worker threads running `process_frame`.
+    Iterating over the pipeline yields the results in frame order, so that stateful consumers (eg. blink counting) see
+    the same sequence as a serial loop. At most `queue_size` frames are decoded ahead of the consumer.
+
+    Decoding (OpenCV) and detection (dlib) release the GIL, so decoding overlaps with detection and detection runs on
+    several cores at once. `process_frame` must be safe to call from several threads.
+
+    With a `gate` (eg. a MotionGate), the decoder thread asks it whether each frame needs full processing, and
+    `process_frame` is called as `process_frame(frame, reference)`: `reference` is None for frames which need full
+    processing, and otherwise the Future of the last fully processed frame, whose results (eg. face locations) can be
+    reused. Waiting on that Future from `process_frame` is safe since it was submitted earlier.
+    """
+
+    def __init__(self, read_frame, process_frame, workers=2, queue_size=None, executor=None, gate=None):
+        """
+        :param read_frame: callable returning the next frame, or None at the end of the video
+        :param process_frame: callable run on each frame by the worker threads
+        :param workers: number of worker threads
+        :param queue_size: Optional - how many frames can be decoded ahead of the consumer. Defaults to 2 per worker.
+        :param executor: Optional - an existing executor to run `process_frame` with, instead of starting `workers` threads
+        :param gate: Optional - object with a `needs_detection(frame)` method deciding which frames are fully processed
+        """
+        self.read_frame = read_frame
+        self.process_frame = process_frame
+        self.workers = workers
+        self.queue_size = queue_size or 2 * workers
+        self.executor = executor
+        self.gate = gate
+
+    def _decode(self, executor, pending, stop):
+        reference = None
+        try:
+            while not stop.is_set():
+                frame = self.read_frame()
+                if frame is None:
+                    break
+
+                if self.gate is None:
+                    future = executor.submit(self.process_frame, frame)
+                elif self.gate.needs_detection(frame) or reference is None:
+                    future = reference = executor.submit(self.process_frame, frame, None)
+                else:
+                    future = executor.submit(self.process_frame, frame, reference)
+                self._put(pending, future, stop)
+        except Exception as e:
+            failed = Future()
+            failed.set_exception(e)
+            self._put(pending, failed, stop)
+        finally:
+            self._put(pending, _END, stop)
+
+    @staticmethod
+    def _put(pending, item, stop):
+        # Don't block forever on a full queue once the consumer is gone
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        executor = self.executor or ThreadPoolExecutor(self.workers)
+        pending = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+        decoder = threading.Thread(target=self._decode, args=(executor, pending, stop), daemon=True)
+        decoder.start()
+
+        try:
+            while True:
+                item = pending.get()
+                if item is _END:
+                    break
+                yield item.result()
+        finally:
+            stop.set()
+            decoder.join()
+            if self.executor is None:
+                executor.shutdown(wait=True)
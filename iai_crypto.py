@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Chunked authenticated encryption of datalake objects.
+
+Objects are encrypted in chunks of `chunk_size` bytes with an AEAD cipher, so
+that they can be encrypted and decrypted as streams with constant memory. The
+nonce of each chunk is made of a random prefix, the chunk number and a flag
+set on the last chunk, so that reordered, dropped or truncated chunks fail
+authentication. Layout of an encrypted object:
+
+  magic 'IAIE' | version (1 byte) | chunk_size (4 bytes) | nonce prefix (7 bytes)
+  chunk 0 ciphertext + tag | chunk 1 ciphertext + tag | ...
+
+The header is authenticated with every chunk. Requires the `cryptography`
+package.
+"""
+import base64
+import io
+import os
+import struct
+
+MAGIC = b'IAIE'
+VERSION = 1
+CHUNK_SIZE = 1 << 20
+TAG_SIZE = 16
+_HEADER = struct.Struct('>4sBI7s')
+
+
+class DecryptionError(Exception):
+  pass
+
+
+def _aead_class(cipher):
+  try:
+    from cryptography.hazmat.primitives.ciphers import aead
+  except ImportError:
+    raise ImportError("Encrypted datalakes require the cryptography package: pip install cryptography")
+
+  name = cipher.upper().replace('_', '-')
+  if name in ('AES-GCM', 'AES-128-GCM', 'AES-192-GCM', 'AES-256-GCM'):
+    return aead.AESGCM
+  if name == 'CHACHA20-POLY1305':
+    return aead.ChaCha20Poly1305
+  raise ValueError("Unsupported cipher: {}".format(cipher))
+
+
+def new_aead(cipher, key):
+  """
+  Return the AEAD for an IAI cipher name (AES-GCM or CHACHA20-POLY1305) and
+  a base64 encoded key
+  """
+  return _aead_class(cipher)(base64.b64decode(key))
+
+
+def _nonce(prefix, counter, last):
+  return prefix + struct.pack('>IB', counter, 1 if last else 0)
+
+
+class EncryptingWriter(io.RawIOBase):
+  """
+  Writable file object encrypting what is written to `raw`, one chunk at a
+  time. Must be closed to write the last chunk.
+  """
+  def __init__(self, raw, aead, chunk_size=CHUNK_SIZE):
+    self._raw = raw
+    self._aead = aead
+    self._chunk_size = chunk_size
+    self._prefix = os.urandom(7)
+    self._header = _HEADER.pack(MAGIC, VERSION, chunk_size, self._prefix)
+    self._buffer = bytearray()
+    self._counter = 0
+    raw.write(self._header)
+
+  def writable(self):
+    return True
+
+  def write(self, b):
+    self._buffer += b
+    # Keep at least one byte so that the last chunk is written by close()
+    while len(self._buffer) > self._chunk_size:
+      self._write_chunk(bytes(self._buffer[:self._chunk_size]), False)
+      del self._buffer[:self._chunk_size]
+    return len(b)
+
+  def _write_chunk(self, plaintext, last):
+    self._raw.write(self._aead.encrypt(_nonce(self._prefix, self._counter, last), plaintext, self._header))
+    self._counter += 1
+
+  def close(self):
+    if not self.closed:
+      try:
+        self._write_chunk(bytes(self._buffer), True)
+        self._raw.close()
+      finally:
+        super().close()
+
+
+class DecryptingReader(io.RawIOBase):
+  """
+  Readable file object decrypting `raw` one chunk at a time
+
+  :raise DecryptionError: when reading a chunk which was modified, or when the
+  object is truncated
+  """
+  def __init__(self, raw, aead):
+    self._raw = raw
+    self._aead = aead
+    header = raw.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+      raise DecryptionError("Truncated header")
+    magic, version, chunk_size, self._prefix = _HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+      raise DecryptionError("Not an encrypted datalake object")
+    self._header = header
+    self._cipher_chunk_size = chunk_size + TAG_SIZE
+    self._pending = b''
+    self._plaintext = b''
+    self._offset = 0
+    self._counter = 0
+    self._eof = False
+
+  def readable(self):
+    return True
+
+  def _next_chunk(self):
+    # Read one byte past the chunk to know whether it is the last one
+    data = self._pending + self._raw.read(self._cipher_chunk_size + 1 - len(self._pending))
+    last = len(data) <= self._cipher_chunk_size
+    chunk, self._pending = data[:self._cipher_chunk_size], data[self._cipher_chunk_size:]
+    try:
+      self._plaintext = self._aead.decrypt(_nonce(self._prefix, self._counter, last), chunk, self._header)
+    except Exception:
+      raise DecryptionError("Chunk {} failed authentication".format(self._counter))
+    self._offset = 0
+    self._counter += 1
+    self._eof = last
+
+  def readinto(self, b):
+    while self._offset == len(self._plaintext):
+      if self._eof:
+        return 0
+      self._next_chunk()
+
+    n = min(len(b), len(self._plaintext) - self._offset)
+    b[:n] = self._plaintext[self._offset:self._offset + n]
+    self._offset += n
+    return n
+
+  def close(self):
+    if not self.closed:
+      try:
+        self._raw.close()
+      finally:
+        super().close()
+
+
+def open_encrypted(path, mode, cipher, key, chunk_size=CHUNK_SIZE):
+  """
+  Open an encrypted datalake object for reading ('rb') or writing ('wb') as a
+  buffered binary file object
+  """
+  aead = new_aead(cipher, key)
+  if mode == 'rb':
+    raw = open(path, 'rb')
+    try:
+      return io.BufferedReader(DecryptingReader(raw, aead), chunk_size)
+    except Exception:
+      raw.close()
+      raise
+  if mode == 'wb':
+    return io.BufferedWriter(EncryptingWriter(open(path, 'wb'), aead, chunk_size), chunk_size)
+  raise ValueError("Unsupported mode: {}".format(mode))
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage latency metrics of the analytics.
+
+Analytics time their stages with a StageTimings, in whichever process they
+run. When they end, the histograms of their session are sent to the server
+process and merged into REGISTRY, which renders them in the Prometheus text
+format.
+"""
+from contextlib import contextmanager
+from threading import Lock
+import bisect
+import os
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, from single frame
+# stages to whole analytics
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class StageTimings(object):
+  """
+  Durations of the stages of one analytics session. Safe to use from several
+  threads (eg. the frame pipeline workers).
+  """
+  def __init__(self):
+    self._lock = Lock()
+    self._stages = {}
+
+  @contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, time.perf_counter() - start)
+
+  def add(self, name, seconds):
+    with self._lock:
+      stage = self._stages.get(name)
+      if stage is None:
+        # bucket counts (+Inf last), sum, count, max
+        stage = self._stages[name] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0.0]
+      stage[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+      stage[1] += seconds
+      stage[2] += 1
+      stage[3] = max(stage[3], seconds)
+
+  def histograms(self):
+    """
+    Picklable snapshot of the histograms, to be merged with
+    Registry.merge_session()
+    """
+    with self._lock:
+      return {name: (list(buckets), total, count) for name, (buckets, total, count, _) in self._stages.items()}
+
+  def summary(self):
+    """
+    A dict of the 'count', 'total_s', 'mean_ms' and 'max_ms' of each stage
+    """
+    with self._lock:
+      return {
+        name: {'count': count, 'total_s': round(total, 3), 'mean_ms': round(1000 * total / count, 3), 'max_ms': round(1000 * maximum, 3)}
+        for name, (_, total, count, maximum) in self._stages.items()
+      }
+
+
+class Registry(object):
+  """
+  Stage histograms and session counters aggregated over every analytics
+  """
+  def __init__(self):
+    self._lock = Lock()
+    self._stages = {}
+    self._sessions = {}
+
+  def merge_session(self, histograms, outcome):
+    """
+    Add the histograms of a finished session
+
+    :param histograms: StageTimings.histograms() of the session, or None
+    :param outcome: 'completed', 'failed' or 'cancelled'
+    """
+    with self._lock:
+      self._sessions[outcome] = self._sessions.get(outcome, 0) + 1
+      for name, (buckets, total, count) in (histograms or {}).items():
+        stage = self._stages.setdefault(name, [[0] * (len(BUCKETS) + 1), 0.0, 0])
+        stage[0] = [a + b for a, b in zip(stage[0], buckets)]
+        stage[1] += total
+        stage[2] += count
+
+  def render(self, extra_gauges=None, extra_counters=None):
+    """
+    The metrics in the Prometheus text exposition format
+
+    :param extra_gauges: Optional - dict of more gauge names and values to expose (eg. the queue depth)
+    :param extra_counters: Optional - dict of more counter names (ending with _total) and values to expose (eg. the
+    rejected analytics)
+    """
+    lines = [
+      '# HELP iai_stage_seconds Duration of the stages of the analytics',
+      '# TYPE iai_stage_seconds histogram',
+    ]
+    with self._lock:
+      for name in sorted(self._stages):
+        buckets, total, count = self._stages[name]
+        cumulative = 0
+        for bound, n in zip([repr(b) for b in BUCKETS] + ['+Inf'], buckets):
+          cumulative += n
+          lines.append('iai_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, bound, cumulative))
+        lines.append('iai_stage_seconds_sum{{stage="{}"}} {}'.format(name, repr(total)))
+        lines.append('iai_stage_seconds_count{{stage="{}"}} {}'.format(name, count))
+
+      lines.append('# HELP iai_sessions_total Analytics sessions which ended, by outcome')
+      lines.append('# TYPE iai_sessions_total counter')
+      for outcome in sorted(self._sessions):
+        lines.append('iai_sessions_total{{outcome="{}"}} {}'.format(outcome, self._sessions[outcome]))
+
+    for name, value in sorted((extra_counters or {}).items()):
+      lines.append('# TYPE {} counter'.format(name))
+      lines.append('{} {}'.format(name, value))
+    for name, value in sorted((extra_gauges or {}).items()):
+      lines.append('# TYPE {} gauge'.format(name))
+      lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def rss_bytes(pid):
+  """
+  Resident memory of a process, or None when it can't be read (not Linux, or
+  the process is gone)
+  """
+  try:
+    with open('/proc/{}/statm'.format(pid)) as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+REGISTRY = Registry()
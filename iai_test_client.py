@@ -1,14 +1,50 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import random
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from flask import Flask, jsonify, request
 
 cback_app = Flask(__name__)
+# Simulate a slow or unreliable IAI endpoint to exercise callback retries
+cback_app.config['DELAY'] = 0.0
+cback_app.config['FAIL_RATE'] = 0.0
 
-@cback_app.route('/callback')
+@cback_app.route('/callback', methods=['GET', 'POST'])
 def callback():
-  print("Callback received!!!")
+  time.sleep(cback_app.config['DELAY'])
+  if random.random() < cback_app.config['FAIL_RATE']:
+    print("Callback failed on purpose: {}".format(request.form.to_dict()))
+    return ('', 503)
+  print("Callback received!!! {}".format(request.form.to_dict()))
+  return ('', 204)
+
+# Sessions of a load test waiting for their callback: session_id ->
+# [start time, Event, callback time, form]
+_load_sessions = {}
+_load_lock = threading.Lock()
+
+@cback_app.route('/callback/<session_id>', methods=['POST'])
+def load_callback(session_id):
+  received = time.time()
+  with _load_lock:
+    session = _load_sessions.get(session_id)
+  if session is not None and not session[1].is_set():
+    session[2] = received
+    session[3] = request.form.to_dict()
+    session[1].set()
+  return ('', 204)
+
+def serve_callbacks(args):
+  cback_app.config['DELAY'] = args.callback_delay
+  cback_app.config['FAIL_RATE'] = args.callback_fail_rate
+  t = threading.Thread(target=cback_app.run, kwargs={'host': '0.0.0.0', 'port': args.callback_port}, daemon=True)
+  t.start()
+  return "http://{}:{}/callback".format(args.callback_host, args.callback_port)
 
 def send_start(args):
   url = "{}/startAnalytics".format(args.target)
@@ -28,11 +64,126 @@ def send_start(args):
     iai_datacipher=None,
     iai_datakey=None,
     iai_files=args.files,
-    on_finish_url=None)
+    on_finish_url=serve_callbacks(args) if args.callback_port else None)
 
   ret = requests.post(url, json=payload)
   print("Server response: [status={}, body={}]".format(ret.status_code, ret.json() if ret.status_code == 200 else ret.content.decode('UTF-8')))
 
+  if args.callback_port:
+    # Keep serving callbacks until interrupted
+    try:
+      while True:
+        time.sleep(1)
+    except KeyboardInterrupt:
+      pass
+
+def percentiles(values):
+  values = sorted(values)
+  if not values:
+    return {}
+  def at(q):
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+  return {'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': round(values[-1], 3)}
+
+def run_session(args, url, on_finish_url, index):
+  session_id = '{}-{}'.format(args.session_prefix, index)
+  session = [time.time(), threading.Event(), None, None]
+  with _load_lock:
+    _load_sessions[session_id] = session
+
+  iai_params = dict(args.params)
+  if not args.allow_cache:
+    # Distinct parameters so that the server's result cache doesn't answer
+    iai_params['load_test_session'] = session_id
+  payload = dict(
+    session_id=session_id,
+    iai_datalake=args.datalake,
+    iai_datacipher=None,
+    iai_datakey=None,
+    iai_params=iai_params,
+    iai_files=args.files,
+    on_finish_url='{}/{}'.format(on_finish_url, session_id))
+
+  for attempt in range(args.retry_rejected + 1):
+    try:
+      ret = requests.post(url, json=payload, timeout=30)
+    except requests.RequestException as e:
+      return {'error': type(e).__name__}
+    if ret.status_code != 503 or attempt == args.retry_rejected:
+      break
+    # Rejected by the admission control of the server: retry when told to
+    time.sleep(float(ret.headers.get('Retry-After', 1)))
+    session[0] = time.time()
+  if ret.status_code not in (200, 204):
+    return {'error': 'HTTP {}'.format(ret.status_code)}
+
+  if not session[1].wait(args.session_timeout):
+    return {'error': 'timeout'}
+  return {
+    'latency': session[2] - session[0],
+    'error': None if session[3].get('success') == 'True' else 'failed',
+  }
+
+def sample_server(args, samples, stop):
+  while not stop.is_set():
+    try:
+      status = requests.get('{}/status'.format(args.target), timeout=5).json()
+      samples.append({'time': time.time(), 'rss_bytes': status.get('rss_bytes'), 'running': status.get('running'), 'queued': status.get('queued')})
+    except (requests.RequestException, ValueError):
+      pass
+    stop.wait(args.sample_interval)
+
+def send_load(args):
+  """
+  Run args.sessions analytics, at most args.concurrency at once, and report the
+  latency from start request to on_finish callback, throughput, errors and the
+  resident memory of the server over time
+  """
+  url = "{}/startAnalytics".format(args.target)
+  on_finish_url = serve_callbacks(args)
+  time.sleep(1)
+
+  samples = []
+  stop = threading.Event()
+  sampler = threading.Thread(target=sample_server, args=(args, samples, stop), daemon=True)
+  sampler.start()
+
+  started = time.time()
+  with ThreadPoolExecutor(args.concurrency) as executor:
+    results = list(executor.map(lambda i: run_session(args, url, on_finish_url, i), range(args.sessions)))
+  elapsed = time.time() - started
+  stop.set()
+  sampler.join()
+
+  latencies = [r['latency'] for r in results if 'latency' in r]
+  errors = {}
+  for r in results:
+    if r['error']:
+      errors[r['error']] = errors.get(r['error'], 0) + 1
+  rss = [s['rss_bytes'] for s in samples if s['rss_bytes']]
+  report = {
+    'sessions': args.sessions,
+    'concurrency': args.concurrency,
+    'elapsed_s': round(elapsed, 3),
+    'throughput_per_s': round(sum(1 for r in results if not r['error']) / elapsed, 3),
+    'error_rate': round(sum(errors.values()) / float(args.sessions), 3),
+    'errors': errors,
+    'latency_s': percentiles(latencies),
+    'rss_mb': {'min': round(min(rss) / 2**20, 1), 'max': round(max(rss) / 2**20, 1), 'last': round(rss[-1] / 2**20, 1)} if rss else None,
+    'samples': samples,
+  }
+
+  print("{} sessions in {:.1f}s, concurrency {}: {:.2f} sessions/s, error rate {:.1%} {}".format(
+    args.sessions, elapsed, args.concurrency, report['throughput_per_s'], report['error_rate'], errors))
+  print("Latency (s): {}".format(report['latency_s']))
+  print("Server RSS (MB): {}".format(report['rss_mb']))
+  for s in samples:
+    print("  t={:7.1f}s rss={} running={} queued={}".format(
+      s['time'] - started, round(s['rss_bytes'] / 2**20, 1) if s['rss_bytes'] else None, s['running'], s['queued']))
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
 def send_stop(args):
   url = "{}/stopAnalytics".format(args.target)
 
@@ -47,8 +198,28 @@ def main():
   p_start = subparsers.add_parser('start')
   p_start.add_argument('--datalake', '-dl', required=True)
   p_start.add_argument('--session-id', default='1234')
+  p_start.add_argument('--callback-port', type=int, help="Serve on_finish callbacks on this port")
+  p_start.add_argument('--callback-host', default='localhost', help="Address where the server can reach the callback port")
+  p_start.add_argument('--callback-delay', type=float, default=0.0, help="Seconds to wait before answering callbacks")
+  p_start.add_argument('--callback-fail-rate', type=float, default=0.0, help="Fraction of callbacks answered with an error")
   p_start.add_argument('files', nargs='+')
 
+  p_load = subparsers.add_parser('load', help="Run many concurrent sessions and report latencies")
+  p_load.add_argument('--datalake', '-dl', required=True)
+  p_load.add_argument('--sessions', '-n', type=int, default=20)
+  p_load.add_argument('--concurrency', '-c', type=int, default=4)
+  p_load.add_argument('--session-prefix', default='load-{}'.format(int(time.time())))
+  p_load.add_argument('--params', type=json.loads, default={}, help="iai_params of the sessions, as JSON")
+  p_load.add_argument('--allow-cache', action='store_true', help="Let the server answer identical sessions from its result cache")
+  p_load.add_argument('--retry-rejected', type=int, default=0, help="How many times to retry sessions rejected with 503, after their Retry-After")
+  p_load.add_argument('--session-timeout', type=float, default=600, help="Seconds to wait for the callback of a session")
+  p_load.add_argument('--sample-interval', type=float, default=1.0, help="Seconds between samples of the server status")
+  p_load.add_argument('--callback-port', type=int, default=5099)
+  p_load.add_argument('--callback-host', default='localhost', help="Address where the server can reach the callback port")
+  p_load.add_argument('--output', help="Save the report to this JSON file")
+  p_load.add_argument('files', nargs='+')
+  p_load.set_defaults(callback_delay=0.0, callback_fail_rate=0.0)
+
   p_stop = subparsers.add_parser('stop')
   p_stop.add_argument('--session-id', default='1234')
 
@@ -57,6 +228,8 @@ def main():
 
   if args.action == 'start':
     send_start(args)
+  elif args.action == 'load':
+    send_load(args)
   elif args.action == 'stop':
     send_stop(args)
 
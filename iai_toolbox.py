@@ -1,10 +1,31 @@
 # -*- coding: utf-8 -*-
 from collections import UserDict
-from multiprocessing import Process
-from threading import Thread
+from multiprocessing import Process, Queue, SimpleQueue, Pipe
+from threading import Thread, Lock, Event
+import cProfile
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import marshal
+import math
+import mmap
 import os
+import pstats
+import queue
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+import iai_crypto
+import iai_metrics
 
 
 Log = logging.getLogger('server.iai')
@@ -36,6 +57,711 @@ class _AnalyticsPool(UserDict):
 def get_analytics_pool():
   return _AnalyticsPool.instance()
 
+def _worker_main(inbox, events, initializer, initargs):
+  """
+  Main loop of a pooled worker process: run analytics one after the other
+  until a None job is received
+  """
+  if initializer is not None:
+    initializer(*initargs)
+
+  while True:
+    agent = inbox.get()
+    if agent is None:
+      return
+
+    outcome = 'failed'
+    try:
+      agent._run()
+      outcome = 'completed'
+    except Exception:
+      Log.exception('Analytics with session_id=%s failed', agent.get_session_id())
+    finally:
+      events.put((os.getpid(), agent.get_session_id(), outcome, agent.timings.histograms()))
+
+def _process_main(agent, send):
+  """
+  Main of an analytics run in its own process: send back its outcome and
+  stage histograms
+  """
+  outcome = 'failed'
+  try:
+    agent._run()
+    outcome = 'completed'
+  finally:
+    send.send((outcome, agent.timings.histograms()))
+
+class _Worker(object):
+  def __init__(self, process, inbox):
+    self.process = process
+    self.inbox = inbox
+    self.session_id = None
+    self.started = None
+    self.on_done = None
+
+class PoolSaturated(Exception):
+  """
+  Raised when an analytics is submitted while the queue of the worker pool is
+  full. `retry_after` is an estimate of the seconds until a slot frees up.
+  """
+  def __init__(self, queued, retry_after):
+    super().__init__('{} analytics already queued'.format(queued))
+    self.queued = queued
+    self.retry_after = retry_after
+
+class _AnalyticsWorkerPool(object):
+  """
+  Long-lived worker processes to which analytics are dispatched, so that the
+  start-up cost (imports, model loading) is paid once per worker instead of
+  once per request.
+
+  Each worker runs one analytics at a time. Analytics submitted while all the
+  workers are busy wait by decreasing priority, then in FIFO order. At most
+  `max_queue` analytics can wait: submitting more raises PoolSaturated. A
+  place can be reserved before submitting, to reject requests before doing
+  any work for them. Cancelling a running analytics kills its worker, which is replaced by a
+  fresh one.
+  """
+  POLL_INTERVAL = 1.0
+  # Retry-After estimate until the duration of an analytics was measured
+  DEFAULT_RETRY_AFTER = 10
+
+  def __init__(self, processes, initializer=None, initargs=(), max_queue=None):
+    self._initializer = initializer
+    self._initargs = initargs
+    self._processes = processes
+    self._max_queue = max_queue
+    self._events = Queue()
+    self._lock = Lock()
+    self._pending = []
+    self._sequence = itertools.count()
+    self._idle = []
+    self._busy = {}
+    self._workers = {}
+    self._reserved = 0
+    self._submitted = 0
+    self._rejected = 0
+    self._dispatched = 0
+    self._completed = 0
+    self._wait_total = 0.0
+    self._wait_max = 0.0
+    self._run_total = 0.0
+
+    for _ in range(processes):
+      self._spawn()
+
+    Thread(target=self._collect, daemon=True).start()
+
+  def _spawn(self):
+    inbox = SimpleQueue()
+    p = Process(target=_worker_main, args=(inbox, self._events, self._initializer, self._initargs))
+    p.daemon = True
+    p.start()
+
+    worker = _Worker(p, inbox)
+    self._workers[p.pid] = worker
+    self._idle.append(worker)
+    Log.debug('Started analytics worker pid=%s', p.pid)
+
+  def _dispatch(self):
+    # Called with self._lock held
+    while self._idle and self._pending:
+      _, _, queued_at, agent, on_done = heapq.heappop(self._pending)
+      worker = self._idle.pop()
+      worker.session_id = agent.get_session_id()
+      worker.on_done = on_done
+      worker.started = time.time()
+      wait = worker.started - queued_at
+      self._dispatched += 1
+      self._wait_total += wait
+      self._wait_max = max(self._wait_max, wait)
+      self._busy[worker.session_id] = worker
+      Log.debug('Dispatch session_id=%s to worker pid=%s', worker.session_id, worker.process.pid)
+      worker.inbox.put(agent)
+
+  def _release(self, worker):
+    # Called with self._lock held, returns the on_done callback to call once
+    # the lock is released
+    if self._busy.get(worker.session_id) is worker:
+      del self._busy[worker.session_id]
+    on_done, worker.on_done = worker.on_done, None
+    worker.session_id = None
+    return on_done
+
+  def _collect(self):
+    while True:
+      try:
+        pid, session_id, outcome, histograms = self._events.get(timeout=self.POLL_INTERVAL)
+      except queue.Empty:
+        pid = None
+
+      done = []
+      with self._lock:
+        worker = self._workers.get(pid)
+        if worker is not None and worker.session_id == session_id:
+          iai_metrics.REGISTRY.merge_session(histograms, outcome)
+          self._completed += 1
+          self._run_total += time.time() - worker.started
+          done.append(self._release(worker))
+          self._idle.append(worker)
+
+        # Replace workers which died on their own (eg. crash in native code)
+        for dead in [w for w in self._workers.values() if not w.process.is_alive()]:
+          Log.error('Analytics worker pid=%s died while running session_id=%s', dead.process.pid, dead.session_id)
+          if dead.session_id is not None:
+            iai_metrics.REGISTRY.merge_session(None, 'failed')
+          done.append(self._remove(dead))
+          self._spawn()
+
+        self._dispatch()
+
+      if done and _callback_dispatcher is not None:
+        # The analytics which ended probably queued its callback
+        _callback_dispatcher.notify()
+      self._call(done)
+
+  @staticmethod
+  def _call(callbacks):
+    for on_done in callbacks:
+      if on_done is None:
+        continue
+      try:
+        on_done()
+      except Exception:
+        Log.exception('Analytics on_done callback failed')
+
+  def _remove(self, worker):
+    # Called with self._lock held
+    on_done = self._release(worker)
+    self._workers.pop(worker.process.pid, None)
+    if worker in self._idle:
+      self._idle.remove(worker)
+    return on_done
+
+  def _retry_after(self):
+    # Called with self._lock held: one worker frees up every mean run
+    # duration / number of workers
+    if not self._completed:
+      return self.DEFAULT_RETRY_AFTER
+    return max(1, int(math.ceil(self._run_total / self._completed / self._processes)))
+
+  def _admit(self):
+    # Called with self._lock held. Reserved places count as queued analytics
+    # (as long as there are idle workers, nothing is queued).
+    waiting = len(self._pending) + self._reserved
+    if self._max_queue is not None and waiting >= len(self._idle) + self._max_queue:
+      self._rejected += 1
+      raise PoolSaturated(waiting, self._retry_after())
+
+  def reserve(self):
+    """
+    Reserve a place in the queue for an analytics which is submitted later
+    with reserved=True. Call release() instead if it is not submitted.
+
+    :raise PoolSaturated: when the queue is full
+    """
+    with self._lock:
+      self._admit()
+      self._reserved += 1
+
+  def release(self):
+    """
+    Give back a place reserved with reserve()
+    """
+    with self._lock:
+      self._reserved -= 1
+
+  def submit(self, agent, priority=0, on_done=None, reserved=False):
+    """
+    Queue an analytics to be run by the next available worker. Analytics with
+    a higher priority are run first. `on_done()` is called in this process
+    once the analytics ended, failed or was cancelled.
+
+    :param reserved: whether a place was reserved for it with reserve()
+    :raise PoolSaturated: when the queue is full
+    """
+    with self._lock:
+      if reserved:
+        self._reserved -= 1
+      else:
+        self._admit()
+
+      self._submitted += 1
+      heapq.heappush(self._pending, (-priority, next(self._sequence), time.time(), agent, on_done))
+      self._dispatch()
+
+  def cancel(self, session_id):
+    """
+    Drop a queued analytics, or kill the worker running it
+
+    :return: True if the analytics was queued or running
+    """
+    worker = None
+    with self._lock:
+      for i, (_, _, _, agent, on_done) in enumerate(self._pending):
+        if agent.get_session_id() == session_id:
+          self._pending.pop(i)
+          heapq.heapify(self._pending)
+          break
+      else:
+        worker = self._busy.get(session_id)
+        if worker is None:
+          return False
+
+        on_done = self._remove(worker)
+        iai_metrics.REGISTRY.merge_session(None, 'cancelled')
+        worker.process.terminate()
+        self._spawn()
+        self._dispatch()
+
+    if worker is not None:
+      worker.process.join()
+    self._call([on_done])
+    return True
+
+  @property
+  def pids(self):
+    """
+    Process ids of the workers
+    """
+    with self._lock:
+      return list(self._workers)
+
+  @property
+  def stats(self):
+    """
+    A dict with the number of workers, of 'running' and 'queued' analytics,
+    counters of 'submitted', 'rejected' and 'completed' analytics, and the
+    mean and max time analytics waited in the queue, in seconds
+    """
+    with self._lock:
+      return {
+        'workers': self._processes,
+        'running': len(self._busy),
+        'queued': len(self._pending),
+        'reserved': self._reserved,
+        'max_queue': self._max_queue,
+        'submitted': self._submitted,
+        'rejected': self._rejected,
+        'completed': self._completed,
+        'wait_mean': self._wait_total / self._dispatched if self._dispatched else 0.0,
+        'wait_max': self._wait_max,
+      }
+
+_worker_pool = None
+_worker_pool_config = None
+_worker_pool_lock = Lock()
+
+def configure_worker_pool(processes, initializer=None, initargs=(), max_queue=None):
+  """
+  Run analytics in a pool of `processes` long-lived workers, each calling
+  `initializer(*initargs)` once when it starts. At most `max_queue` analytics
+  wait for a worker (None = no limit). The pool is created on first use.
+  With processes=0 each analytics runs in its own new process.
+  """
+  global _worker_pool_config
+  _worker_pool_config = (processes, initializer, initargs, max_queue)
+
+def get_worker_pool():
+  """
+  Return the worker pool, or None when analytics run in their own process
+  """
+  global _worker_pool
+  if not _worker_pool_config or not _worker_pool_config[0]:
+    return None
+
+  with _worker_pool_lock:
+    if _worker_pool is None:
+      _worker_pool = _AnalyticsWorkerPool(*_worker_pool_config)
+    return _worker_pool
+
+def _write_outbox(outbox, url, payload):
+  """
+  Durably queue a callback in the outbox directory. The file is written
+  atomically so the dispatcher never reads a partial callback.
+  """
+  os.makedirs(outbox, exist_ok=True)
+  name = '{:020d}-{}.json'.format(time.time_ns(), uuid.uuid4().hex)
+  tmp_path = os.path.join(outbox, '.' + name + '.tmp')
+  with open(tmp_path, 'w') as f:
+    # Form values are sent as strings anyway, so keep whatever can't be JSON encoded as a string
+    json.dump({'url': url, 'payload': payload, 'attempts': 0, 'next_attempt': 0}, f, default=str)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, os.path.join(outbox, name))
+
+class _CallbackDispatcher(object):
+  """
+  Deliver the on_finish callbacks queued in an outbox directory from a
+  background thread, so analytics don't wait on the IAI endpoint.
+
+  Callbacks are posted with a pooled HTTP session and a timeout. Failed
+  deliveries are retried with exponential backoff, and after `max_attempts`
+  the callback is moved to the 'failed' subdirectory of the outbox. Queued
+  callbacks survive server restarts.
+  """
+  def __init__(self, outbox, timeout=10.0, max_attempts=8, backoff=1.0, max_backoff=300.0, poll_interval=0.5):
+    self.outbox = outbox
+    self.timeout = timeout
+    self.max_attempts = max_attempts
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.poll_interval = poll_interval
+    self.delivered = 0
+    self.failed = 0
+    self._wakeup = Event()
+    self._stopped = False
+
+    self._session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
+
+    os.makedirs(os.path.join(outbox, 'failed'), exist_ok=True)
+    self._thread = Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def notify(self):
+    """
+    Wake the dispatcher up when a new callback was queued
+    """
+    self._wakeup.set()
+
+  def stop(self):
+    """
+    Stop delivering callbacks once the current round of deliveries is over.
+    Callbacks not delivered yet stay in the outbox.
+    """
+    self._stopped = True
+    self._wakeup.set()
+    self._thread.join()
+
+  def _run(self):
+    while True:
+      self._wakeup.wait(self.poll_interval)
+      self._wakeup.clear()
+      if self._stopped:
+        return
+      try:
+        self._deliver_due()
+      except Exception:
+        Log.exception('Callback dispatcher failed')
+
+  def _deliver_due(self):
+    for name in sorted(os.listdir(self.outbox)):
+      path = os.path.join(self.outbox, name)
+      if not name.endswith('.json') or name.startswith('.'):
+        continue
+
+      try:
+        with open(path) as f:
+          callback = json.load(f)
+      except FileNotFoundError:
+        continue
+      if callback['next_attempt'] > time.time():
+        continue
+
+      try:
+        r = self._session.post(callback['url'], callback['payload'], timeout=self.timeout)
+        r.raise_for_status()
+      except requests.RequestException as e:
+        self._retry(path, name, callback, e)
+      else:
+        os.remove(path)
+        self.delivered += 1
+
+  def _retry(self, path, name, callback, error):
+    callback['attempts'] += 1
+    if callback['attempts'] >= self.max_attempts:
+      Log.error('Giving up callback to %s after %d attempts: %s', callback['url'], callback['attempts'], error)
+      shutil.move(path, os.path.join(self.outbox, 'failed', name))
+      self.failed += 1
+      return
+
+    delay = min(self.max_backoff, self.backoff * 2 ** (callback['attempts'] - 1))
+    Log.warning('Callback to %s failed (%s), retrying in %.1fs', callback['url'], error, delay)
+    callback['next_attempt'] = time.time() + delay
+    tmp_path = os.path.join(self.outbox, '.' + name + '.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(callback, f)
+    os.replace(tmp_path, path)
+
+_callback_dispatcher = None
+
+def start_callback_dispatcher(outbox, **kwargs):
+  """
+  Deliver on_finish callbacks in the background through the given outbox
+  directory. Must be called in the server process; analytics started
+  afterwards (in any process) queue their callbacks there.
+  """
+  global _callback_dispatcher
+  _callback_dispatcher = _CallbackDispatcher(outbox, **kwargs)
+  return _callback_dispatcher
+
+_file_digests = {}
+
+def _file_digest(path, compute=True):
+  """
+  sha256 of a file, remembered as long as its size and mtime don't change.
+  With compute=False, None when it isn't remembered.
+  """
+  st = os.stat(path)
+  memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+  digest = _file_digests.get(memo_key)
+  if digest is None and compute:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    digest = h.hexdigest()
+    if len(_file_digests) > 1024:
+      _file_digests.clear()
+    _file_digests[memo_key] = digest
+  return digest
+
+def store_result(directory, key, outputs, payload):
+  """
+  Save the outputs and callback payload of a successful analytics in the
+  result cache. Called from the process running the analytics.
+  """
+  final_path = os.path.join(directory, key)
+  if os.path.exists(final_path):
+    return
+
+  tmp_path = os.path.join(directory, '.{}.{}.tmp'.format(key, uuid.uuid4().hex))
+  os.makedirs(tmp_path)
+  names = {}
+  for i, (name, content) in enumerate(outputs.items()):
+    names[name] = 'output{}'.format(i)
+    with open(os.path.join(tmp_path, names[name]), 'wb') as f:
+      f.write(content)
+  with open(os.path.join(tmp_path, 'result.json'), 'w') as f:
+    json.dump({'outputs': names, 'payload': payload}, f, default=str)
+
+  try:
+    os.rename(tmp_path, final_path)
+  except OSError:
+    # Stored concurrently by another analytics
+    shutil.rmtree(tmp_path, ignore_errors=True)
+
+class ResultCache(object):
+  """
+  Results of successful analytics, keyed on the request parameters and the
+  content of the input files, so that analytics retried with the same inputs
+  are answered from the cache: the cached outputs are written to the new
+  datalake and the on_finish callback is delivered again.
+
+  Analytics started while another one with the same key is running don't
+  run: they get its results once it ended. Entries older than `max_age`
+  seconds are dropped, as well as the least recently used ones once the
+  cache takes more than `max_bytes`.
+
+  Analytics on encrypted data are never cached. Retried and duplicate
+  analytics are answered (or attached) first, from the digests of their inputs
+  remembered by an earlier request. Otherwise, with a worker pool, a place is
+  reserved in its queue before the inputs are hashed, so that requests
+  rejected with PoolSaturated don't hash anything.
+  """
+  def __init__(self, directory, max_age=24 * 3600, max_bytes=256 * 1024 * 1024):
+    self.directory = directory
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.coalesced = 0
+    self.misses = 0
+    self._lock = Lock()
+    self._inflight = {}
+
+    os.makedirs(directory, exist_ok=True)
+    self.evict()
+
+  def key(self, agent, hash_inputs=True):
+    """
+    Key of the results of an analytics, or None when they can't be cached.
+    With hash_inputs=False, also None when an input wasn't hashed yet.
+    """
+    if agent.params.iai_datacipher:
+      return None
+
+    data, paths = agent.result_key_data()
+    h = hashlib.sha256(json.dumps([type(agent).__name__, data], sort_keys=True, default=str).encode('utf-8'))
+    try:
+      for path in paths:
+        digest = _file_digest(path, hash_inputs)
+        if digest is None:
+          return None
+        h.update(digest.encode('ascii'))
+    except OSError:
+      # Missing input: let the analytics fail as usual
+      return None
+    return h.hexdigest()
+
+  def get(self, key):
+    """
+    :return: the cached (outputs, payload) of a key, or None
+    """
+    path = os.path.join(self.directory, key)
+    try:
+      with open(os.path.join(path, 'result.json')) as f:
+        result = json.load(f)
+      outputs = {}
+      for name, filename in result['outputs'].items():
+        with open(os.path.join(path, filename), 'rb') as f:
+          outputs[name] = f.read()
+      # Touch the entry so that eviction keeps recently used results
+      os.utime(path)
+    except (OSError, ValueError):
+      return None
+    return outputs, result['payload']
+
+  def evict(self):
+    entries = []
+    for entry in os.scandir(self.directory):
+      if entry.name.startswith('.') or not entry.is_dir():
+        continue
+      try:
+        size = sum(f.stat().st_size for f in os.scandir(entry.path))
+        entries.append((entry.stat().st_mtime, size, entry.path))
+      except OSError:
+        continue
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for mtime, size, path in sorted(entries):
+      if total <= self.max_bytes and now - mtime <= self.max_age:
+        continue
+      shutil.rmtree(path, ignore_errors=True)
+      total -= size
+
+  def start(self, agent):
+    """
+    Answer an analytics from the cache, attach it to a running analytics with
+    the same key, or start it
+    """
+    # Invalid requests fail before anything is reserved
+    agent.priority()
+
+    key = self.key(agent, hash_inputs=False)
+    if key is not None and self._answer(agent, key, claim=False):
+      return
+
+    worker_pool = get_worker_pool()
+    if worker_pool is not None:
+      worker_pool.reserve()
+    reserved = worker_pool is not None
+
+    try:
+      key = self.key(agent)
+      if key is not None and self._answer(agent, key, claim=True):
+        return
+      # From here the reservation is used, or given back, by agent._launch()
+      reserved = False
+      if key is None:
+        return agent._launch(reserved=worker_pool is not None)
+      self._launch(agent, key, reserved=worker_pool is not None)
+    finally:
+      if reserved:
+        worker_pool.release()
+
+  def _answer(self, agent, key, claim):
+    """
+    Attach an analytics to a running one with the same key, or answer it from
+    the cache. With claim=True, a miss marks the key as running.
+
+    :return: True if the analytics was attached or answered
+    """
+    with self._lock:
+      followers = self._inflight.get(key)
+      if followers is not None:
+        Log.info('session_id=%s waits for the results of a running analytics', agent.get_session_id())
+        self.coalesced += 1
+        followers.append(agent)
+        return True
+
+      result = self.get(key)
+      if result is None:
+        if claim:
+          self.misses += 1
+          self._inflight[key] = []
+        return False
+      self.hits += 1
+
+    Log.info('session_id=%s answered from the result cache', agent.get_session_id())
+    self._deliver(agent, result)
+    return True
+
+  def _launch(self, agent, key, reserved=False):
+    agent.result_key = (self.directory, key)
+    try:
+      agent._launch(on_done=functools.partial(self._done, key), reserved=reserved)
+    except Exception:
+      with self._lock:
+        self._inflight.pop(key, None)
+      raise
+
+  def _deliver(self, agent, result):
+    outputs, payload = result
+    for name, content in outputs.items():
+      agent.write_output(name, content)
+    agent.on_finish(payload['success'], payload['value'], payload['resuls'])
+
+  def _done(self, key):
+    with self._lock:
+      followers = self._inflight.pop(key, [])
+      result = self.get(key)
+      if result is None and followers:
+        # The analytics failed or was cancelled: run the next one instead
+        self._inflight[key] = followers[1:]
+
+    if result is not None:
+      for agent in followers:
+        try:
+          self._deliver(agent, result)
+        except Exception:
+          Log.exception('Could not deliver results to session_id=%s', agent.get_session_id())
+    elif followers:
+      try:
+        self._launch(followers[0], key)
+      except Exception as e:
+        Log.error('Could not start session_id=%s: %s', followers[0].get_session_id(), e)
+        for agent in followers:
+          agent.on_finish(False, 'Analytics could not be started', [])
+    self.evict()
+
+  def discard(self, agent):
+    """
+    Stop waiting for the results of a running analytics
+
+    :return: True if the analytics was waiting
+    """
+    with self._lock:
+      for followers in self._inflight.values():
+        if agent in followers:
+          followers.remove(agent)
+          return True
+    return False
+
+  @property
+  def stats(self):
+    """
+    A dict with the number of 'hits', 'coalesced' analytics and 'misses'
+    """
+    return {'hits': self.hits, 'coalesced': self.coalesced, 'misses': self.misses}
+
+_result_cache = None
+
+def configure_result_cache(directory, **kwargs):
+  """
+  Answer analytics retried with the same inputs from a ResultCache in the
+  given directory. Must be called in the server process.
+  """
+  global _result_cache
+  _result_cache = ResultCache(directory, **kwargs) if directory else None
+  return _result_cache
+
+def get_result_cache():
+  return _result_cache
+
 class AnalyticsRequest(object):
   session_id = None
   iai_datalake = None
@@ -69,7 +795,7 @@ class AnalyticsRequest(object):
     ar.iai_datacipher = payload['iai_datacipher']
     ar.iai_datakey = payload['iai_datakey']
     ar.iai_files = payload['iai_files']
-    ar.iai_params = getattr(payload, 'iai_params', None)
+    ar.iai_params = payload.get('iai_params')
     ar.on_finish_url = payload['on_finish_url']
 
     return ar
@@ -79,18 +805,185 @@ class AnalyticsRequest(object):
     return "<AnalyticsRequest {}>".format(attributes)
 
 
+# Size of the chunks of read_input(mode='chunks')
+READ_CHUNK_SIZE = 1 << 20
+
 class AnalyticsAgent(object):
+  # Timeout of on_finish callbacks posted synchronously, when no callback
+  # dispatcher is running
+  CALLBACK_TIMEOUT = 10.0
+
   def __init__(self, params):
     self.params = params
     self.p = None
+    self.outbox = None
+    self.result_key = None
+    self._outputs = {}
+    self._temp_dir = None
+    self._fifos = []
+    self._terminated = False
+    self._started = None
+    self._profiling = False
+    self._profiler = None
+    self.timings = None
 
   def get_session_id(self):
     return self.params.session_id
 
+  def get_param(self, name, default=None):
+    """
+    Return an analytics parameter provided by IAI in iai_params
+    """
+    return (self.params.iai_params or {}).get(name, default)
+
+  def priority(self):
+    """
+    The 'priority' iai_param
+
+    :raise ValueError: when it is not an integer
+    """
+    return int(self.get_param('priority', 0))
+
   def start(self):
-    self.p = p = Process(target=self.run)
+    """
+    Start the analytics, or queue it when all the pooled workers are busy. The
+    'priority' iai_param orders queued analytics (higher first).
+
+    :raise PoolSaturated: when the queue of the worker pool is full
+    """
+    # Analytics may run in another process: remember where to queue callbacks
+    if _callback_dispatcher is not None:
+      self.outbox = _callback_dispatcher.outbox
+
+    if _result_cache is not None:
+      return _result_cache.start(self)
+    return self._launch()
+
+  def _launch(self, on_done=None, reserved=False):
+    worker_pool = get_worker_pool()
+    if worker_pool is not None:
+      try:
+        priority = self.priority()
+      except Exception:
+        if reserved:
+          worker_pool.release()
+        raise
+      return worker_pool.submit(self, priority=priority, on_done=on_done, reserved=reserved)
+
+    recv, send = Pipe(duplex=False)
+    self.p = p = Process(target=_process_main, args=(self, send))
     p.daemon = True
-    return p.start()
+    p.start()
+    send.close()
+
+    def wait():
+      try:
+        outcome, histograms = recv.recv()
+      except EOFError:
+        # Terminated, or died in native code
+        outcome, histograms = 'cancelled' if self._terminated else 'failed', None
+      recv.close()
+      p.join()
+      iai_metrics.REGISTRY.merge_session(histograms, outcome)
+      if on_done is not None:
+        on_done()
+    Thread(target=wait, daemon=True).start()
+
+  def _run(self):
+    self.timings = iai_metrics.StageTimings()
+    self._started = time.time()
+    mode = self._profile_mode()
+    if mode is None:
+      with self.timings.stage('total'):
+        self.run()
+      return
+
+    self._profiling = True
+    self._profiler = cProfile.Profile() if mode in ('cpu', 'all') else None
+    if mode in ('memory', 'all'):
+      tracemalloc.start()
+    try:
+      with self.timings.stage('total'):
+        if self._profiler is not None:
+          self._profiler.runcall(self.run)
+        else:
+          self.run()
+    finally:
+      # Analytics which didn't call on_finish
+      self._write_profile()
+
+  def _profile_mode(self):
+    # 'cpu' (cProfile), 'memory' (tracemalloc) or 'all', from the 'profile'
+    # iai_param or the IAI_PROFILE environment variable
+    mode = self.get_param('profile', os.environ.get('IAI_PROFILE'))
+    if mode in (None, '', '0', 'false', False):
+      return None
+    if mode in (True, '1', 'true'):
+      return 'all'
+    if mode not in ('cpu', 'memory', 'all'):
+      Log.warning('Unknown profile mode %r, profiling disabled', mode)
+      return None
+    return mode
+
+  def _write_profile(self):
+    """
+    Write the profile of the session in the datalake: profile-<session_id>.txt
+    with the hottest functions and memory peaks, and profile-<session_id>.pstats
+    to be loaded with pstats (or snakeviz) for cProfile. Profiling stops then:
+    called by on_finish so that the profile is there once the callback is
+    delivered, or at the end of run() otherwise.
+    """
+    if not self._profiling:
+      return
+    self._profiling = False
+    profiler = self._profiler
+    name = 'profile-{}'.format(self.get_session_id())
+    try:
+      report = io.StringIO()
+      report.write('session_id={} elapsed_s={:.3f}\n'.format(self.get_session_id(), time.time() - self._started))
+      # ru_maxrss is the peak of the whole process, which may have run other
+      # sessions before when it comes from the worker pool
+      report.write('process_lifetime_max_rss_kb={}\n'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+      if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        report.write('\npython_memory_peak_bytes={} python_memory_end_bytes={}\n'.format(peak, current))
+        report.write('Largest allocations still alive at the end:\n')
+        for stat in snapshot.statistics('lineno')[:20]:
+          report.write('  {}\n'.format(stat))
+
+      if profiler is not None:
+        profiler.create_stats()
+        with self._open_output(name + '.pstats') as f:
+          f.write(marshal.dumps(profiler.stats))
+        report.write('\ncProfile of the analytics thread:\n')
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(40)
+
+      with self._open_output(name + '.txt') as f:
+        f.write(report.getvalue().encode('utf-8'))
+      Log.info('Profile of session_id=%s written to %s', self.get_session_id(), self.build_datalake_path(name + '.txt'))
+    except Exception:
+      Log.exception('Could not write the profile of session_id=%s', self.get_session_id())
+
+  def stage(self, name):
+    """
+    Context manager timing a stage of the analytics, for the /metrics
+    histograms and the timings reported in the on_finish results
+    """
+    if self.timings is None:
+      self.timings = iai_metrics.StageTimings()
+    return self.timings.stage(name)
+
+  def result_key_data(self):
+    """
+    What the results of the analytics depend on, for the result cache: a JSON
+    serializable object and a list of files whose content matters. Override
+    to add settings or local files (eg. models, reference images).
+    """
+    data = {'files': self.params.iai_files, 'params': self.params.iai_params}
+    return data, [self.build_datalake_path(f) for f in self.params.iai_files]
 
   def terminate(self):
     # Handle real terminate in separate thread in order to not block server
@@ -98,22 +991,41 @@ class AnalyticsAgent(object):
     Thread(target = self._terminate_thread).start()
 
   def _terminate_thread(self):
+    self._terminated = True
     try:
       # Tell analytics to terminate
       self.end()
     finally:
-      self.p.terminate()
+      worker_pool = get_worker_pool()
+      if self.p is not None:
+        self.p.terminate()
+      elif _result_cache is not None and _result_cache.discard(self):
+        pass
+      elif worker_pool is not None:
+        worker_pool.cancel(self.get_session_id())
 
   def on_finish(self, success, value, resuls):
+    self._write_profile()
+    if self.timings is not None:
+      timings = {'elapsed_s': round(time.time() - self._started, 3) if self._started else None, 'stages': self.timings.summary()}
+      resuls = list(resuls) + [json.dumps({'timings': timings})]
+
     payload = {
       'success': success,
       'value': value,
       'resuls': resuls
     }
+    if success and self.result_key is not None:
+      store_result(*self.result_key, self._outputs, payload)
+
     if not self.params.on_finish_url:
       Log.error('[WARNING] No on_finish_url provided in request (payload={})'.format(payload))
+    elif self.outbox is not None:
+      _write_outbox(self.outbox, self.params.on_finish_url, payload)
+      if _callback_dispatcher is not None:
+        _callback_dispatcher.notify()
     else:
-      requests.post(self.params.on_finish_url, payload)
+      requests.post(self.params.on_finish_url, payload, timeout=self.CALLBACK_TIMEOUT)
 
   def run(self):
     raise NotImplementedError("Call abstract method run()")
@@ -124,30 +1036,128 @@ class AnalyticsAgent(object):
   def build_datalake_path(self, *args):
     return os.path.join(self.params.iai_datalake, *args)
 
-  def read_input(self, dpoid):
+  def _open_input(self, dpoid):
+    path = self.build_datalake_path(dpoid)
+    if not self.params.iai_datacipher:
+      return open(path, 'rb')
+    return iai_crypto.open_encrypted(path, 'rb', self.params.iai_datacipher, self.params.iai_datakey, READ_CHUNK_SIZE)
+
+  def _temp_path(self, dpoid):
+    if self._temp_dir is None:
+      self._temp_dir = tempfile.mkdtemp(prefix='iai-input-')
+    return os.path.join(self._temp_dir, '{}-{}'.format(len(os.listdir(self._temp_dir)), os.path.basename(dpoid)))
+
+  def input_path(self, dpoid, seekable=False):
+    """
+    Path of a dpo which can be opened directly by other libraries (eg.
+    cv2.VideoCapture), to avoid loading large inputs in memory
+
+    Encrypted dpos are decrypted on the fly into a named pipe, which can only
+    be read sequentially. With seekable=True (eg. for MP4 files whose index is
+    at the end) they are decrypted to a temporary file instead. Call
+    release_inputs() once done with the returned paths.
+    """
+    if not self.params.iai_datacipher:
+      return self.build_datalake_path(dpoid)
+
+    path = self._temp_path(dpoid)
+    if seekable or not hasattr(os, 'mkfifo'):
+      with self._open_input(dpoid) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+      return path
+
+    os.mkfifo(path, 0o600)
+    self._fifos.append(path)
+    Thread(target=self._feed_fifo, args=(dpoid, path), daemon=True).start()
+    return path
+
+  def _feed_fifo(self, dpoid, path):
+    try:
+      # Blocks until the pipe is opened for reading
+      with self._open_input(dpoid) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, READ_CHUNK_SIZE)
+    except (BrokenPipeError, FileNotFoundError):
+      # The reader stopped before the end, or the pipe was released unused
+      pass
+    except Exception:
+      Log.exception('Could not decrypt %s', dpoid)
+
+  def release_inputs(self):
+    """
+    Remove the named pipes and temporary files created by input_path()
+    """
+    for path in self._fifos:
+      # Unblock the thread feeding a pipe which was never opened
+      try:
+        os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+      except OSError:
+        pass
+    self._fifos = []
+    if self._temp_dir is not None:
+      shutil.rmtree(self._temp_dir, ignore_errors=True)
+      self._temp_dir = None
+
+  def read_input(self, dpoid, mode='bytes', chunk_size=READ_CHUNK_SIZE):
     """
     Read dpo from datalake and perform decrypt using the information provided
     by IAI
+
+    The mode tells how the content is returned:
+    - 'bytes': the whole content (only for small inputs)
+    - 'stream': a binary file object, to be closed by the caller
+    - 'chunks': an iterator of bytes objects of at most chunk_size bytes
+    - 'mmap': a read-only mmap of the file, to be closed by the caller (empty
+      bytes for empty files, which can't be mapped). Encrypted dpos are
+      decrypted to a temporary file first, see release_inputs().
+
+    Encrypted dpos are decrypted one chunk at a time, and a chunk which was
+    tampered with raises iai_crypto.DecryptionError when it is read.
     """
+    if mode not in ('bytes', 'stream', 'chunks', 'mmap'):
+      raise ValueError("Unknown read_input mode: {}".format(mode))
 
-    path = self.build_datalake_path(dpoid)
-    if not self.params.iai_datacipher:
-      with open(path, 'rb') as f:
-        return f.read()
+    if mode == 'chunks':
+      return self._read_chunks(dpoid, chunk_size)
+    if mode == 'mmap':
+      with open(self.input_path(dpoid, seekable=True), 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+          return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    f = self._open_input(dpoid)
+    if mode == 'stream':
+      return f
+    with f:
+      return f.read()
 
-    raise NotImplementedError("Reading crypted files is not implemented yet")
+  def _read_chunks(self, dpoid, chunk_size):
+    with self._open_input(dpoid) as f:
+      for chunk in iter(lambda: f.read(chunk_size), b''):
+        yield chunk
+
+  def _open_output(self, name):
+    filepath = self.build_datalake_path(name)
+    if not self.params.iai_datacipher:
+      return open(filepath, 'wb')
+    return iai_crypto.open_encrypted(filepath, 'wb', self.params.iai_datacipher, self.params.iai_datakey, READ_CHUNK_SIZE)
 
+  def open_output(self, name):
+    """
+    Create a new file in datalake, returned as a binary file object which
+    encrypts what is written to it using the information provided by IAI. It
+    must be closed once written.
+    """
+    # Outputs written as streams aren't kept by the result cache
+    self.result_key = None
+    return self._open_output(name)
 
   def write_output(self, name, plaintext_content):
     """
     Write new file in datalake and encrypt the contents using the information
     provided by IAI
     """
-    filepath = self.build_datalake_path(name)
-    if not self.params.iai_datacipher:
-      with open(filepath, 'wb') as f:
-        f.write(plaintext_content)
-      return
-
-    raise NotImplementedError("Writing crypted files is not implemented yet")
+    if self.result_key is not None:
+      self._outputs[name] = plaintext_content
+    with self._open_output(name) as f:
+      f.write(plaintext_content)
 
@@ -4,21 +4,28 @@ import os
 from flask import Flask, jsonify, request
 import json
 import jsonschema
+import iai_metrics
 
-from iai_toolbox import AnalyticsRequest, AnalyticsAgent, get_analytics_pool
+from iai_toolbox import AnalyticsRequest, AnalyticsAgent, get_analytics_pool, configure_worker_pool, get_worker_pool, start_callback_dispatcher, PoolSaturated, configure_result_cache, get_result_cache
 import time
 
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
+import contextlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import face_recognition
-from PIL import Image
-from scipy.spatial import distance as dist
+from face_recognition.gallery import open_gallery
+from face_recognition.video import FramePipeline, MotionGate, IntervalGate, GateChain
+from face_recognition.tracking import FaceTracker
+from face_recognition import liveness
+from face_recognition.cache import EncodingCache
+from face_recognition.ann import load_or_build_index
 from imutils.video import FileVideoStream
 from imutils.video import VideoStream
 from imutils.video import WebcamVideoStream
-from imutils import face_utils
-import numpy as np
 import argparse
 import imutils
 import time
@@ -41,21 +48,210 @@ __version__ = ''.join(__version_info__)
 app = Flask(__name__)
 DEBUG=('DEBUG' in os.environ and os.environ['DEBUG'] in ['1', 'true'])
 
+# Reference images of the known people and the persistent gallery holding their
+# encodings. The gallery only re-encodes references that were added or changed.
+REFERENCE_IMAGES = ['./tmp/testiai/7.png']
+INPUT_VIDEO = './tmp/testiai/k.mp4'
+# Inputs which are still images, recognized by their extension or their first
+# bytes, are analysed as INPUT_VIDEO like inputs which are not videos (OpenCV
+# opens them as 1-frame videos)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM', b'II*\x00', b'MM\x00*')
+GALLERY_PATH = os.environ.get('IAI_GALLERY', './tmp/gallery')
+# Each worker checks the reference images for changes at most every that many
+# seconds, and otherwise only reloads the gallery when another worker updated it
+GALLERY_SYNC_INTERVAL = float(os.environ.get('IAI_GALLERY_SYNC_INTERVAL', '60'))
+# Optional approximate nearest neighbour index of the gallery, for very large
+# galleries. IAI_ANN_NPROBE trades recall for speed.
+ANN_INDEX_PATH = os.environ.get('IAI_ANN_INDEX')
+ANN_NPROBE = int(os.environ.get('IAI_ANN_NPROBE', '8'))
+# face_recognition models used by the analytics, loaded once in the server
+# process so that analytics processes inherit them instead of loading them
+MODELS = ['face_detector', 'pose_predictor_5_point', 'face_encoder']
+BLINK_PREDICTOR_PATH = './face_recognition_models/models/spfl.dat'
+# Width the video frames are resized to for blink detection. Face recognition
+# also detects faces at that width, but encodes them at full resolution.
+FRAME_WIDTH = 450
+# Number of long-lived analytics worker processes (0 = one new process per
+# request)
+WORKERS = int(os.environ.get('IAI_WORKERS', os.cpu_count() or 1))
+# Number of analytics which can wait for a busy worker before requests are
+# rejected with 503 (negative = no limit)
+MAX_QUEUE = int(os.environ.get('IAI_MAX_QUEUE', 4 * WORKERS))
+# Number of threads running face detection on the frames of one analytics
+# (overridden by the 'pipeline_workers' iai_param)
+PIPELINE_WORKERS = int(os.environ.get('IAI_PIPELINE_WORKERS', '2'))
+# Skip face detection on frames which barely changed since the last detected
+# one: mean absolute pixel difference threshold (0 = no motion gating) and
+# maximum number of consecutive skipped frames (overridden by the
+# 'motion_threshold' and 'motion_max_skip' iai_params). Without tracking, the
+# face rectangles of the last detected frame are reused. With tracking, the
+# check only runs on the frames picked for full-frame detection, and faces are
+# tracked instead on the ones it skips
+MOTION_THRESHOLD = float(os.environ.get('IAI_MOTION_THRESHOLD', '0'))
+MOTION_MAX_SKIP = int(os.environ.get('IAI_MOTION_MAX_SKIP', '10'))
+# Track faces between frames: full-frame detection only runs every that many
+# frames (or when a track is lost), faces are looked for around their last
+# location in between. 1 = full-frame detection on every frame (overridden by
+# the 'tracking_interval' iai_param)
+TRACKING_INTERVAL = int(os.environ.get('IAI_TRACKING_INTERVAL', '10'))
+# Eyes are closed while their aspect ratio is under EYE_AR_THRESH, a blink
+# counts once they were closed EYE_AR_CONSEC_FRAMES frames in a row
+# (overridden by the 'eye_ar_thresh' and 'eye_ar_consec_frames' iai_params)
+EYE_AR_THRESH = float(os.environ.get('IAI_EYE_AR_THRESH', '0.20'))
+EYE_AR_CONSEC_FRAMES = int(os.environ.get('IAI_EYE_AR_CONSEC_FRAMES', '1'))
+# Face analysis results are cached per process by image content, and in this
+# directory when set, shared by all the workers
+ENCODING_CACHE_DIR = os.environ.get('IAI_ENCODING_CACHE')
+ENCODING_CACHE_MB = int(os.environ.get('IAI_ENCODING_CACHE_MB', '256'))
+# on_finish callbacks are queued in this directory and delivered in the
+# background, with retries, by the server process
+CALLBACK_OUTBOX = os.environ.get('IAI_CALLBACK_OUTBOX', './tmp/outbox')
+CALLBACK_MAX_ATTEMPTS = int(os.environ.get('IAI_CALLBACK_MAX_ATTEMPTS', '8'))
+# Results of analytics are cached by request parameters and input contents,
+# so that retried requests don't run again (empty = disabled)
+RESULT_CACHE_DIR = os.environ.get('IAI_RESULT_CACHE', './tmp/results')
+RESULT_CACHE_MAX_AGE = float(os.environ.get('IAI_RESULT_CACHE_MAX_AGE', 24 * 3600))
+RESULT_CACHE_MB = int(os.environ.get('IAI_RESULT_CACHE_MB', '256'))
+
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
-def eye_aspect_ratio(eye):
-    # compute the euclidean distances between the two sets of
-    # vertical eye landmarks (x, y)-coordinates
-    A = dist.euclidean(eye[1], eye[5])
-    B = dist.euclidean(eye[2], eye[4])
-    # compute the euclidean distance between the horizontal
-    # eye landmark (x, y)-coordinates
-    C = dist.euclidean(eye[0], eye[3])
-    # compute the eye aspect ratio
-    ear = (A + B) / (2.0 * C)
-    # return the eye aspect ratio
-    return ear
+_blink_predictor = None
+_blink_detectors = threading.local()
+_detection_executors = {}
+_encoding_cache = None
+_gallery = None
+_gallery_synced_at = None
+_ann_index = None
+_ann_index_generation = None
+
+def blink_models():
+  """
+  Return the (detector, predictor) pair used by blink detection. The predictor
+  is loaded once per process and shared, while dlib detectors are not
+  thread-safe so each thread gets its own.
+  """
+  global _blink_predictor
+  if _blink_predictor is None:
+    _blink_predictor = dlib.shape_predictor(BLINK_PREDICTOR_PATH)
+  detector = getattr(_blink_detectors, 'detector', None)
+  if detector is None:
+    detector = _blink_detectors.detector = dlib.get_frontal_face_detector()
+  return detector, _blink_predictor
+
+def detection_executor(workers):
+  """
+  Return the per-process thread pool running detection on video frames, so
+  that its threads (and their detectors) are reused across analytics.
+  """
+  executor = _detection_executors.get(workers)
+  if executor is None:
+    executor = _detection_executors[workers] = ThreadPoolExecutor(workers)
+  return executor
+
+def detect_faces(frame, reference=None, reuse=False, stage=None):
+  """
+  Resize a video frame, convert it to grayscale and detect the faces in it.
+  Run by the frame pipeline threads. Returns the original frame along with
+  the resized grayscale one and the faces found in the latter. Both steps are
+  timed with the stage() context manager of the analytics when given.
+
+  When the pipeline gate passes a reference (the pending result of an earlier
+  frame), detection is skipped: with reuse=True the face rectangles of the
+  reference are returned (see MotionGate), otherwise rects is None and the
+  faces are left to the tracker.
+  """
+  stage = stage or (lambda name: contextlib.nullcontext())
+  detector, _ = blink_models()
+  with stage('resize'):
+    gray = cv2.cvtColor(imutils.resize(frame, width=FRAME_WIDTH), cv2.COLOR_BGR2GRAY)
+  if reference is None:
+    with stage('hog_detection'):
+      rects = detector(gray, 0)
+  elif reuse:
+    rects = reference.result()[2]
+  else:
+    rects = None
+  return frame, gray, rects
+
+def encoding_cache():
+  """
+  Return the per-process cache of face analysis results
+  """
+  global _encoding_cache
+  if _encoding_cache is None:
+    _encoding_cache = EncodingCache(directory=ENCODING_CACHE_DIR, max_disk_bytes=ENCODING_CACHE_MB * 1024 * 1024)
+  return _encoding_cache
+
+def known_faces():
+  """
+  Return the per-process gallery of known faces, synced with the reference
+  images every GALLERY_SYNC_INTERVAL seconds
+  """
+  global _gallery, _gallery_synced_at
+  if _gallery is None:
+    _gallery = open_gallery(GALLERY_PATH)
+  now = time.monotonic()
+  if _gallery_synced_at is None or now - _gallery_synced_at >= GALLERY_SYNC_INTERVAL:
+    _gallery.sync(REFERENCE_IMAGES, on_warning=app.logger.warning)
+    _gallery_synced_at = now
+  else:
+    _gallery.refresh()
+  return _gallery
+
+def ann_index(gallery):
+  """
+  Return the per-process ANN index of the gallery, or None when disabled. It
+  is only loaded (or rebuilt) again when the gallery changed.
+  """
+  global _ann_index, _ann_index_generation
+  if not ANN_INDEX_PATH or len(gallery) == 0:
+    return None
+  if _ann_index is None or _ann_index_generation != gallery.generation:
+    _ann_index = load_or_build_index(ANN_INDEX_PATH, gallery.encodings)
+    _ann_index_generation = gallery.generation
+  return _ann_index
+
+def is_image(agent, infile):
+  """
+  Tell whether a datalake input of an analytics is a still image
+  """
+  if os.path.splitext(infile)[1].lower() in IMAGE_EXTENSIONS:
+    return True
+  try:
+    with agent.read_input(infile, mode='stream') as f:
+      header = f.read(12)
+  except Exception:
+    return False
+  return header.startswith(IMAGE_SIGNATURES) or (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+
+def open_input_video(agent, infile):
+  """
+  Open a datalake input of an analytics with OpenCV, which reads it as it
+  goes instead of loading the whole file in memory. Encrypted videos are
+  decrypted through a pipe, or a temporary file for formats which need
+  seeking. Still images and inputs which are not videos are replaced by the
+  sample INPUT_VIDEO.
+  """
+  if not is_image(agent, infile):
+    vs = cv2.VideoCapture(agent.input_path(infile))
+    if not vs.isOpened() and agent.params.iai_datacipher:
+      vs = cv2.VideoCapture(agent.input_path(infile, seekable=True))
+    # Streams whose length is unknown report 0 frames
+    if vs.isOpened() and vs.get(cv2.CAP_PROP_FRAME_COUNT) != 1:
+      return vs
+    vs.release()
+  app.logger.warning('- {} is not a video, using {}'.format(infile, INPUT_VIDEO))
+  return cv2.VideoCapture(INPUT_VIDEO)
+
+def load_models():
+  """
+  Load every model used by the analytics. Called in the server process before
+  serving and as the initializer of the analytics workers.
+  """
+  face_recognition.preload(MODELS)
+  blink_models()
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
 #-----------------------------------------------------------------
@@ -77,7 +273,9 @@ class SampleAnalytics(AnalyticsAgent):
 
     # Hints:
     # - self.params.iai_files will contains input files to process
-    # - self.read_input('dopid') will read input file from datalake
+    # - self.read_input('dopid') will read input file from datalake, use
+    #   mode='stream', 'chunks' or 'mmap' for large inputs, or open
+    #   self.input_path('dopid') directly
     # - self.write_output('filename', 'content') will write content to datalake
 
     # do real analytics here
@@ -85,60 +283,78 @@ class SampleAnalytics(AnalyticsAgent):
     #-----------------------------------------------------------------
     #-----------------------------------------------------------------
     #-----------------------------------------------------------------
-    EYE_AR_THRESH = 0.20
-    EYE_AR_CONSEC_FRAMES = 1
-    COUNTER = 0
-    TOTAL = 0
     
-    detector = dlib.get_frontal_face_detector()
-    predictor = dlib.shape_predictor('./face_recognition_models/models/spfl.dat')
+    pipeline_workers = int(self.get_param('pipeline_workers', PIPELINE_WORKERS))
+    motion_threshold = float(self.get_param('motion_threshold', MOTION_THRESHOLD))
+    motion_max_skip = int(self.get_param('motion_max_skip', MOTION_MAX_SKIP))
+    tracking_interval = int(self.get_param('tracking_interval', TRACKING_INTERVAL))
+    eye_ar_thresh = float(self.get_param('eye_ar_thresh', EYE_AR_THRESH))
+    eye_ar_consec_frames = int(self.get_param('eye_ar_consec_frames', EYE_AR_CONSEC_FRAMES))
     
-    (lStart, lEnd) = face_utils.FACIAL_LANDMARKS_IDXS["left_eye"]
-    (rStart, rEnd) = face_utils.FACIAL_LANDMARKS_IDXS["right_eye"]
-    
-    vs = cv2.VideoCapture("./tmp/testiai/k.mp4")
-    length = int(vs.get(cv2.CAP_PROP_FRAME_COUNT))
+    def read_frame():
+      with self.stage('decode'):
+        ret, frame = vs.read()
+      return frame if ret else None
     
+    with self.stage('gallery'):
+      gallery = known_faces()
+      index = ann_index(gallery)
+
     time.sleep(1.0)
     #-----------------------------------------------------------------
     #-----------------------------------------------------------------
     #-----------------------------------------------------------------
     for infile in self.params.iai_files:
         app.logger.info("- Processing {}".format(infile))
-        content = self.read_input(infile)
-        app.logger.info('[dump input:{}]: {}'.format(infile, content))
+        app.logger.info('- Input {}: {} bytes'.format(infile, os.path.getsize(self.build_datalake_path(infile))))
+        with self.stage('datalake_read'):
+          vs = open_input_video(self, infile)
         time.sleep(2)
             
-        for x in range(length):
-            ret, frame = vs.read()
-            frame = imutils.resize(frame, width=450)
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            rects = detector(gray, 0)
-
-            for rect in rects:
-                shape = predictor(gray, rect)
-                shape = face_utils.shape_to_np(shape)
-                leftEye = shape[lStart:lEnd]
-                rightEye = shape[rStart:rEnd]
-                leftEAR = eye_aspect_ratio(leftEye)
-                rightEAR = eye_aspect_ratio(rightEye)
-                ear = (leftEAR + rightEAR) / 2.0
-                leftEyeHull = cv2.convexHull(leftEye)
-                rightEyeHull = cv2.convexHull(rightEye)
-                if ear < EYE_AR_THRESH:
-                    COUNTER += 1
+        detector, predictor = blink_models()
+        process_frame = functools.partial(detect_faces, stage=self.stage)
+        full_detection_interval = tracking_interval
+        motion_gate = MotionGate(motion_threshold, motion_max_skip) if motion_threshold > 0 else None
+        gate = motion_gate
+        if tracking_interval > 1:
+          gate = IntervalGate(tracking_interval)
+          if motion_gate:
+            # the motion check only runs on the frames picked for full-frame
+            # detection: the tracker must not run it itself on the ones the
+            # motion gate skipped, only when a face is lost
+            gate = GateChain(gate, motion_gate)
+            full_detection_interval = None
+        elif motion_gate:
+          process_frame = functools.partial(detect_faces, reuse=True, stage=self.stage)
+        tracker = FaceTracker(lambda image: detector(image, 0), full_detection_interval)
+
+        frames = FramePipeline(read_frame, process_frame, pipeline_workers, executor=detection_executor(pipeline_workers), gate=gate)
+        for frame, gray, rects in frames:
+            with self.stage('tracking'):
+                tracks = tracker.update(gray, rects)
+            if not tracks:
+                continue
+
+            # eye aspect ratio of every face of the frame at once, blink state
+            # is kept per tracked face
+            with self.stage('shape_prediction'):
+                ears = liveness.eyes_aspect_ratio([liveness.landmarks_to_array(predictor(gray, track.rect)) for track in tracks])
+            for track, ear in zip(tracks, ears):
+                blinks = track.data.setdefault('blinks', liveness.BlinkDetector(eye_ar_thresh, eye_ar_consec_frames))
+                if blinks.update(ear):
                     cv2.imwrite('./tmp/testiai/frameServer2RF.jpg', frame)
                     realFrame = frame
-                    break
-                else:
-                    if COUNTER >= EYE_AR_CONSEC_FRAMES:
-                        TOTAL += 1
-                    COUNTER = 0
-                    
+
                 #------------------------------
                 #------------------------------
                 #------------------------------
-                
+
+        vs.release()
+        self.release_inputs()
+        app.logger.info('- Face tracking on {}: {}'.format(infile, tracker.stats))
+        if motion_gate:
+          app.logger.info('- Motion gate on {}: {}'.format(infile, motion_gate.stats))
+
         # frame = cv2.imread("./tmp/testiai/frameServer2RF.jpg")
         height, width, channels = realFrame.shape
         print (height, width, channels)
@@ -158,29 +374,24 @@ class SampleAnalytics(AnalyticsAgent):
         # print(top1, left1, bottom1, right1)
 
         im1 = realFrame[top1:bottom1, left1:right1]
-        face_locations = face_recognition.face_locations(realFrame)#im1
-
-        # print("Found {} faces in the frame.".format(len(face_locations)))
-
-        for face_location in face_locations:
-            top, right, bottom, left = face_location
-            # print("Face is located at location top: {}, left: {}, bottom: {}, right: {}".format(top, left, bottom, right))
-            
-            face_image = realFrame[top:bottom, left:right]
-            pil_image = Image.fromarray(face_image)
-            # pil_image.save('./tmp/testiai/faceServer3S.jpg')
-            
-            #-------------------------------------
-            #-------------------------------------
-            #-------------------------------------
-            kous_image = face_recognition.load_image_file("./tmp/testiai/7.png")
-            kous_face_encoding = face_recognition.face_encodings(kous_image)[0]
-
-            #test_image = face_recognition.load_image_file("./tmp/testiai/faceServer3S.jpg")
-            test_image = np.array(pil_image)
-            test_face_encoding = face_recognition.face_encodings(test_image)[0]
-            
-            plaintext_output = face_recognition.compare_faces([kous_face_encoding], test_face_encoding)
+        # detect, landmark and encode the faces in a single pass; frames from
+        # OpenCV are BGR while face_recognition expects RGB
+        with self.stage('face_encodings'):
+          faces = encoding_cache().analyze_faces(cv2.cvtColor(realFrame, cv2.COLOR_BGR2RGB), detection_scale=FRAME_WIDTH / float(width))
+        app.logger.info('- Encoding cache: {}'.format(encoding_cache().stats))
+
+        # print("Found {} faces in the frame.".format(len(faces)))
+
+        for face in faces:
+            # print("Face is located at location (top, right, bottom, left): {}".format(face['location']))
+            test_face_encoding = face['encoding']
+
+            with self.stage('matching'):
+              if index is not None:
+                distances = index.search(test_face_encoding, k=1, nprobe=ANN_NPROBE)[1][0]
+                plaintext_output = list(distances <= 0.6)
+              else:
+                plaintext_output = face_recognition.compare_faces(gallery.encodings, test_face_encoding)
             break
         #-----------------------------------------------------------------
         #-----------------------------------------------------------------
@@ -190,7 +401,8 @@ class SampleAnalytics(AnalyticsAgent):
     # bytes content
     plaintext_output = str(plaintext_output[0]).encode('utf-8','ignore')
     plaintext_output = "The ID of the recognized person is ".encode('utf-8','ignore') + plaintext_output + " - server".encode('utf-8','ignore')
-    self.write_output('outfileServer', plaintext_output)
+    with self.stage('datalake_write'):
+      self.write_output('outfileServer', plaintext_output)
 
     app.logger.info('--- run() ended!')
 
@@ -201,6 +413,12 @@ class SampleAnalytics(AnalyticsAgent):
     results = []
     self.on_finish(success, value, results)
 
+  def result_key_data(self):
+    data, paths = super().result_key_data()
+    data['settings'] = [MODELS, FRAME_WIDTH, TRACKING_INTERVAL, MOTION_THRESHOLD, MOTION_MAX_SKIP,
+                        EYE_AR_THRESH, EYE_AR_CONSEC_FRAMES, ANN_INDEX_PATH, ANN_NPROBE]
+    return data, paths + [INPUT_VIDEO, BLINK_PREDICTOR_PATH] + REFERENCE_IMAGES
+
   def end(self):
     app.logger.info('--- Termination request for analytics')
     # insert code here for graceful terminate analytics
@@ -230,7 +448,12 @@ def do_start_analytics():
     analytics_pool.add(process)
 
     # Start analytics
-    process.start()
+    try:
+      process.start()
+    except PoolSaturated as e:
+      analytics_pool.remove(iai_req.session_id)
+      app.logger.warning('Rejected session_id=%s: %s', iai_req.session_id, e)
+      return (jsonify({'error': 'Too many analytics queued'}), 503, {'Retry-After': str(e.retry_after)})
 
     #
     # Return 204 (empty response) when the processing doesn't produce output files
@@ -270,6 +493,46 @@ def do_stop_analytics():
     return (jsonify({'error': 'Error occured'}), 500)
 
 
+def server_rss():
+  # Resident memory of the server and of its pooled analytics workers
+  worker_pool = get_worker_pool()
+  pids = [os.getpid()] + (worker_pool.pids if worker_pool is not None else [])
+  return sum(rss or 0 for rss in map(iai_metrics.rss_bytes, pids))
+
+@app.route('/status', methods = ['GET'])
+def do_status():
+  # Queue depth, wait times and rejections of the worker pool, and result
+  # cache hits
+  worker_pool = get_worker_pool()
+  status = worker_pool.stats if worker_pool is not None else {'workers': 0}
+  status['rss_bytes'] = server_rss()
+  if get_result_cache() is not None:
+    status['result_cache'] = get_result_cache().stats
+  return jsonify(status)
+
+@app.route('/metrics', methods = ['GET'])
+def do_metrics():
+  # Stage latency histograms of the analytics which ended, in the Prometheus
+  # text format, along with the state of the worker pool
+  gauges = {'iai_rss_bytes': server_rss()}
+  counters = {}
+  worker_pool = get_worker_pool()
+  if worker_pool is not None:
+    stats = worker_pool.stats
+    gauges.update({
+      'iai_workers': stats['workers'],
+      'iai_running_analytics': stats['running'],
+      'iai_queued_analytics': stats['queued'],
+      'iai_queue_wait_mean_seconds': stats['wait_mean'],
+      'iai_queue_wait_max_seconds': stats['wait_max'],
+    })
+    counters['iai_rejected_analytics_total'] = stats['rejected']
+  return (iai_metrics.REGISTRY.render(gauges, counters), 200, {'Content-Type': 'text/plain; version=0.0.4'})
+
 
 if __name__ == '__main__':
+  load_models()
+  start_callback_dispatcher(CALLBACK_OUTBOX, max_attempts=CALLBACK_MAX_ATTEMPTS)
+  configure_result_cache(RESULT_CACHE_DIR, max_age=RESULT_CACHE_MAX_AGE, max_bytes=RESULT_CACHE_MB * 1024 * 1024)
+  configure_worker_pool(WORKERS, initializer=load_models, max_queue=MAX_QUEUE if MAX_QUEUE >= 0 else None)
   app.run(host = '0.0.0.0', port = 5000, debug = DEBUG)
\ No newline at end of file
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from face_recognition.cache import EncodingCache
+
+
+class EncodingCacheDiskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _disk_usage(self):
+        return sum(os.path.getsize(os.path.join(self.directory, name)) for name in os.listdir(self.directory))
+
+    def test_directory_scanned_only_when_full(self):
+        value = {"encodings": np.zeros((1, 128))}
+        cache = EncodingCache(max_entries=1, directory=self.directory, max_disk_bytes=10 * 1024)
+        cache.put("first", value)
+        entry_size = self._disk_usage()
+        entries = cache.max_disk_bytes // entry_size
+
+        with mock.patch("face_recognition.cache.os.scandir", wraps=os.scandir) as scandir:
+            for i in range(entries - 1):
+                cache.put(str(i), value)
+            self.assertEqual(scandir.call_count, 0)
+
+            cache.put("last", value)
+            self.assertEqual(scandir.call_count, 1)
+        self.assertLessEqual(self._disk_usage(), cache.max_disk_bytes)
+        self.assertEqual(len(os.listdir(self.directory)), entries)
+
+    def test_evicted_entries_missed(self):
+        value = {"encodings": np.ones((1, 128))}
+        cache = EncodingCache(max_entries=1, directory=self.directory, max_disk_bytes=1)
+        cache.put("a", value)
+        cache.put("b", value)
+
+        # Another process sharing the directory
+        cache = EncodingCache(directory=self.directory)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats["misses"], 2)
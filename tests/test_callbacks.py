@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import iai_toolbox
+
+
+class _CallbackServer(ThreadingHTTPServer):
+    """
+    Local on_finish endpoint answering 500 to a share `failure_rate` of the callbacks, recording the others
+    """
+
+    def __init__(self, failure_rate):
+        super().__init__(('127.0.0.1', 0), _CallbackHandler)
+        self.failure_rate = failure_rate
+        self.random = random.Random(0)
+        self.received = []
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/on_finish'.format(self.server_address[1])
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with self.server.lock:
+            self.server.requests += 1
+            failed = self.server.random.random() < self.server.failure_rate
+            if not failed:
+                self.server.received.append(parse_qs(body.decode('utf-8'))['value'][0])
+        self.send_response(500 if failed else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _wait_for(condition, timeout=10.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('Timed out')
+        time.sleep(0.01)
+
+
+class CallbackDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outbox = tempfile.mkdtemp()
+        self.dispatchers = []
+
+    def tearDown(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.stop()
+        shutil.rmtree(self.outbox)
+
+    def _server(self, failure_rate):
+        server = _CallbackServer(failure_rate)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def _dispatcher(self, max_attempts):
+        dispatcher = iai_toolbox._CallbackDispatcher(self.outbox, timeout=2.0, max_attempts=max_attempts, backoff=0.01,
+                                                     max_backoff=0.05, poll_interval=0.01)
+        self.dispatchers.append(dispatcher)
+        return dispatcher
+
+    def _queue(self, url, value):
+        iai_toolbox._write_outbox(self.outbox, url, {'success': True, 'value': value, 'resuls': []})
+
+    def _queued(self):
+        return [name for name in os.listdir(self.outbox) if name.endswith('.json')]
+
+    def test_delivered_after_retries(self):
+        server = self._server(failure_rate=0.5)
+        dispatcher = self._dispatcher(max_attempts=30)
+        values = ['session-{}'.format(i) for i in range(10)]
+        for value in values:
+            self._queue(server.url, value)
+        dispatcher.notify()
+
+        _wait_for(lambda: dispatcher.delivered == len(values))
+        self.assertEqual(sorted(server.received), values)
+        self.assertGreater(server.requests, len(values))
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(os.listdir(os.path.join(self.outbox, 'failed')), [])
+
+    def test_outbox_survives_restart(self):
+        server = self._server(failure_rate=1.0)
+        dispatcher = self._dispatcher(max_attempts=1000)
+        self._queue(server.url, 'session-1')
+        _wait_for(lambda: server.requests >= 2)
+        dispatcher.stop()
+        self.assertEqual(len(self._queued()), 1)
+
+        # The endpoint is back up, and the server restarted with the same outbox
+        server.failure_rate = 0.0
+        dispatcher = self._dispatcher(max_attempts=1000)
+
+        _wait_for(lambda: dispatcher.delivered == 1)
+        self.assertEqual(server.received, ['session-1'])
+        self.assertEqual(self._queued(), [])
+
+    def test_failed_after_last_attempt(self):
+        server = self._server(failure_rate=1.0)
+        dispatcher = self._dispatcher(max_attempts=3)
+        self._queue(server.url, 'session-1')
+        dispatcher.notify()
+
+        _wait_for(lambda: dispatcher.failed == 1)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(self._queued(), [])
+        self.assertEqual(len(os.listdir(os.path.join(self.outbox, 'failed'))), 1)
+        self.assertEqual(server.received, [])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from face_recognition import liveness
+
+
+def _landmarks(eye_height):
+    # 68 point landmarks whose eyes are 6 wide and 2 * eye_height tall
+    landmarks = np.zeros((68, 2))
+    eye = np.array([(0, 0), (2, -eye_height), (4, -eye_height), (6, 0), (4, eye_height), (2, eye_height)], dtype=np.float64)
+    landmarks[liveness.LEFT_EYE] = eye
+    landmarks[liveness.RIGHT_EYE] = eye + (20, 0)
+    return landmarks
+
+
+class EyesAspectRatioTest(unittest.TestCase):
+
+    def test_no_faces(self):
+        ears = liveness.eyes_aspect_ratio([])
+        self.assertEqual(ears.shape, (0,))
+        self.assertEqual(list(zip([], ears)), [])
+
+    def test_empty_stack(self):
+        self.assertEqual(liveness.eyes_aspect_ratio(np.empty((0, 68, 2))).shape, (0,))
+        self.assertEqual(liveness.eyes_aspect_ratio(np.empty((3, 0, 68, 2))).shape, (3, 0))
+
+    def test_faces(self):
+        ears = liveness.eyes_aspect_ratio([_landmarks(3), _landmarks(0.3)])
+        np.testing.assert_allclose(ears, [1.0, 0.1])
+
+    def test_single_face(self):
+        self.assertAlmostEqual(float(liveness.eyes_aspect_ratio(_landmarks(1.5))), 0.5)
+
+
+class BlinksTest(unittest.TestCase):
+
+    def test_count_blinks_matches_detector(self):
+        ears = [0.3, 0.1, 0.1, 0.3, 0.1, 0.3, 0.3, 0.1]
+        detector = liveness.BlinkDetector(threshold=0.2, consec_frames=2)
+        for ear in ears:
+            detector.update(ear)
+        self.assertEqual(detector.total, 1)
+        self.assertEqual(liveness.count_blinks(ears, threshold=0.2, consec_frames=2), 1)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server
+from iai_toolbox import AnalyticsRequest
+
+
+def _write_video(path, frames):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+    for i in range(frames):
+        writer.write(np.full((48, 64, 3), i * 20, np.uint8))
+    writer.release()
+
+
+class OpenInputVideoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.datalake = tempfile.mkdtemp()
+        self.sample_video = os.path.join(self.datalake, 'sample.avi')
+        _write_video(self.sample_video, 5)
+
+        params = AnalyticsRequest()
+        params.iai_datalake = self.datalake
+        self.agent = server.SampleAnalytics(params)
+
+    def tearDown(self):
+        self.agent.release_inputs()
+        shutil.rmtree(self.datalake)
+
+    def _frame_count(self, infile):
+        with mock.patch.object(server, 'INPUT_VIDEO', self.sample_video):
+            vs = server.open_input_video(self.agent, infile)
+        try:
+            self.assertTrue(vs.isOpened())
+            return int(vs.get(cv2.CAP_PROP_FRAME_COUNT))
+        finally:
+            vs.release()
+
+    def test_video_input(self):
+        _write_video(os.path.join(self.datalake, 'input.avi'), 8)
+        self.assertEqual(self._frame_count('input.avi'), 8)
+
+    def test_image_input_uses_sample_video(self):
+        cv2.imwrite(os.path.join(self.datalake, 'Chandler.jpg'), np.zeros((48, 64, 3), np.uint8))
+        self.assertEqual(self._frame_count('Chandler.jpg'), 5)
+
+    def test_image_input_without_extension_uses_sample_video(self):
+        cv2.imwrite(os.path.join(self.datalake, 'image.png'), np.zeros((48, 64, 3), np.uint8))
+        os.rename(os.path.join(self.datalake, 'image.png'), os.path.join(self.datalake, 'dpo-1'))
+        self.assertEqual(self._frame_count('dpo-1'), 5)
+
+    def test_unreadable_input_uses_sample_video(self):
+        with open(os.path.join(self.datalake, 'notes.txt'), 'w') as f:
+            f.write('not a video')
+        self.assertEqual(self._frame_count('notes.txt'), 5)
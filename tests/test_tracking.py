@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import dlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from face_recognition.tracking import FaceTracker
+
+
+class _Detector(object):
+    """
+    Fake detector finding one face at a fixed place of the full frames, recording the size of the images it ran on
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, image):
+        self.calls.append(image.shape[:2])
+        if image.shape[:2] == (240, 320):
+            return [dlib.rectangle(100, 80, 160, 140)]
+        # Region of interest around the face
+        return [dlib.rectangle(30, 30, 90, 90)]
+
+
+class FaceTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.frame = np.zeros((240, 320), np.uint8)
+        self.detect = _Detector()
+
+    def test_first_frame_runs_full_detection(self):
+        tracker = FaceTracker(self.detect, full_detection_interval=10)
+        tracks = tracker.update(self.frame)
+        self.assertEqual(len(tracks), 1)
+        self.assertEqual(tracks[0].location, (80, 160, 140, 100))
+        self.assertEqual(tracker.stats["full_detections"], 1)
+        self.assertEqual(self.detect.calls, [(240, 320)])
+
+    def test_faces_are_followed_between_full_detections(self):
+        tracker = FaceTracker(self.detect, full_detection_interval=3)
+        for _ in range(4):
+            tracks = tracker.update(self.frame)
+            self.assertEqual(len(tracks), 1)
+        self.assertEqual(tracker.stats, {"full_detections": 2, "roi_detections": 2, "tracks_started": 1})
+
+    def test_given_detections(self):
+        tracker = FaceTracker(self.detect, full_detection_interval=10)
+        self.assertEqual(tracker.update(self.frame, []), [])
+        self.assertEqual(self.detect.calls, [])
+        self.assertEqual(tracker.stats["full_detections"], 1)
+
+    def test_no_full_detection_interval(self):
+        tracker = FaceTracker(self.detect, full_detection_interval=None)
+        for _ in range(20):
+            self.assertEqual(len(tracker.update(self.frame)), 1)
+        self.assertEqual(tracker.stats["full_detections"], 1)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from face_recognition.video import GateChain, IntervalGate, MotionGate
+
+
+class GateChainTest(unittest.TestCase):
+
+    def test_motion_checked_on_interval_frames_only(self):
+        motion = MotionGate(threshold=2.0, max_skip=10)
+        gate = GateChain(IntervalGate(5), motion)
+        still = np.zeros((48, 64), np.uint8)
+        moved = np.full((48, 64), 100, np.uint8)
+
+        decisions = [gate.needs_detection(still) for _ in range(10)]
+        decisions += [gate.needs_detection(moved) for _ in range(5)]
+        self.assertEqual([i for i, needed in enumerate(decisions) if needed], [0, 10])
+        self.assertEqual(motion.stats, {"detected": 2, "skipped": 1})